@@ -23,10 +23,16 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # ***************************************************************************
+import json
 import os
 import pwem
-from chai1.constants import CHAI1, CHAI1_ENV_NAME, CHAI1_DEFAULT_VERSION
-from pyworkflow.utils import runJob
+from chai1.constants import (CHAI1, CHAI1_ENV_NAME, CHAI1_DEFAULT_VERSION,
+                             CHAI1_ENV_ACTIVATION,
+                             CHAI1_WORKER_ADDRESS, CHAI1_CACHE_DIR,
+                             CHAI1_PREDICTION_CACHE_SIZE, CHAI1_MSA_STORE_SIZE,
+                             CHAI1_EMBEDDING_CACHE_SIZE,
+                             CHAI1_FASTA_URL,
+                             CHAI1_FASTA_CACHE_TTL, RCSB_FASTA_URL)
 
 __version__ = "0.0.1"  # Plugin version
 
@@ -38,27 +44,137 @@ V1 = "0.6.1"
 class Plugin(pwem.Plugin):
     _url = "https://github.com/scipion-em/scipion-em-chai1"
     _supportedVersions = [V1]  # Binary version
+    _fastaFetcher = None
+    _chaiEnv = None  # False when it could not be resolved, see getChaiEnv
+
+    @classmethod
+    def _defineVariables(cls):
+        # Unix socket of the persistent chai-lab worker, see scripts/chai1_worker.py
+        cls._defineVar(CHAI1_WORKER_ADDRESS, '')
+        cls._defineVar(CHAI1_CACHE_DIR,
+                       os.path.join(os.path.expanduser('~'), '.cache',
+                                    'scipion-chai1'))
+        cls._defineVar(CHAI1_PREDICTION_CACHE_SIZE, 20)
+        cls._defineVar(CHAI1_MSA_STORE_SIZE, 10)
+        cls._defineVar(CHAI1_EMBEDDING_CACHE_SIZE, 20)
+        cls._defineVar(CHAI1_FASTA_URL, RCSB_FASTA_URL)
+        cls._defineVar(CHAI1_FASTA_CACHE_TTL, 7 * 24)
+
+    @classmethod
+    def getWorkerAddress(cls):
+        return cls.getVar(CHAI1_WORKER_ADDRESS)
+
+    @classmethod
+    def getCachePath(cls, *paths):
+        return os.path.join(cls.getVar(CHAI1_CACHE_DIR), *paths)
+
+    @classmethod
+    def getPredictionCache(cls):
+        from .cache import PredictionCache
+        maxSize = float(cls.getVar(CHAI1_PREDICTION_CACHE_SIZE)) * 1024 ** 3
+        return PredictionCache(cls.getCachePath('predictions'), maxSize)
+
+    @classmethod
+    def getMsaStore(cls):
+        from .cache import MsaStore
+        maxSize = float(cls.getVar(CHAI1_MSA_STORE_SIZE)) * 1024 ** 3
+        return MsaStore(cls.getCachePath('msas'), maxSize)
+
+    @classmethod
+    def getEmbeddingCache(cls):
+        """ Directory and maximum size in bytes of the ESM embedding cache
+        used by scripts/embedding_cache.py. """
+        maxSize = float(cls.getVar(CHAI1_EMBEDDING_CACHE_SIZE)) * 1024 ** 3
+        return [cls.getCachePath('embeddings'), maxSize]
+
+    @classmethod
+    def getEmbeddingCacheArgs(cls):
+        cacheDir, maxSize = cls.getEmbeddingCache()
+        return ['--embedding-cache', cacheDir,
+                '--embedding-cache-size', str(int(maxSize))]
+
+    @classmethod
+    def getFastaFetcher(cls):
+        """ Shared FASTA fetcher, so the pooled session is reused. """
+        if cls._fastaFetcher is None:
+            from .utils import FastaFetcher
+            ttl = float(cls.getVar(CHAI1_FASTA_CACHE_TTL)) * 3600
+            cls._fastaFetcher = FastaFetcher(url=cls.getVar(CHAI1_FASTA_URL),
+                                             cacheDir=cls.getCachePath('rcsb'),
+                                             ttl=ttl)
+        return cls._fastaFetcher
 
     @classmethod
     def getEnvActivation(cls):
-        return f"conda activate chai1_env"
+        return CHAI1_ENV_ACTIVATION
 
     @classmethod
-    def getEnviron(cls, gpuID=None):
-        """ Setup the environment variables needed to launch the program. """
+    def getEnviron(cls, gpuID=None, chaiEnv=None):
+        """ Setup the environment variables needed to launch the program.
+        With a resolved chaiEnv (see getChaiEnv) the variables set by
+        conda activate are prepared, so its executables run directly. """
         import pyworkflow.utils as pwutils
         environ = pwutils.Environ(os.environ)
         if 'PYTHONPATH' in environ:
             # this is required for python virtual env to work
             del environ['PYTHONPATH']
 
+        if chaiEnv is not None:
+            environ.set('PATH', os.path.join(chaiEnv['prefix'], 'bin'),
+                        position=pwutils.Environ.BEGIN)
+            environ.update({'CONDA_PREFIX': chaiEnv['prefix'],
+                            'CONDA_DEFAULT_ENV': CHAI1_ENV_NAME})
+
         if gpuID is not None:
             environ["CUDA_VISIBLE_DEVICES"] = gpuID
 
         return environ
 
+    @classmethod
+    def getChaiEnv(cls):
+        """ Prefix, python interpreter and chai-lab entry point of the Chai-1
+        environment. They are resolved with conda only once and cached in
+        CHAI1_CACHE_DIR/environment.json while the executables do not change.
+        Returns None if the environment cannot be resolved; the failure is
+        remembered for the rest of the process, so conda is not activated
+        again on every call. """
+        from .utils import resolveEnvironment, isEnvironmentValid
+        if cls._chaiEnv is False:
+            return None
+        if isEnvironmentValid(cls._chaiEnv, CHAI1_ENV_NAME):
+            return cls._chaiEnv
+
+        cacheFile = cls.getCachePath('environment.json')
+        chaiEnv = None
+        if os.path.exists(cacheFile):
+            with open(cacheFile) as f:
+                chaiEnv = json.load(f)
+        if not isEnvironmentValid(chaiEnv, CHAI1_ENV_NAME):
+            chaiEnv = resolveEnvironment('%s %s' % (cls.getCondaActivationCmd(),
+                                                    cls.getEnvActivation()),
+                                         CHAI1_ENV_NAME)
+            if chaiEnv is not None:
+                os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+                with open(cacheFile + '.tmp', 'w') as f:
+                    json.dump(chaiEnv, f)
+                os.replace(cacheFile + '.tmp', cacheFile)
+        cls._chaiEnv = False if chaiEnv is None else chaiEnv
+        return chaiEnv
+
+    @classmethod
+    def getChaiExecutable(cls, program):
+        """ Path of program ('python' or 'chai-lab') in the Chai-1
+        environment, None if the environment is not resolved. """
+        chaiEnv = cls.getChaiEnv()
+        if chaiEnv is None or program not in chaiEnv['executables']:
+            return None
+        return chaiEnv['executables'][program][0]
+
     @classmethod
     def getChaiProgram(cls, program):
+        python = cls.getChaiExecutable('python')
+        if python is not None:
+            return '%s %s' % (python, program)
         cmd = '%s %s && python %s' % (cls.getCondaActivationCmd(), cls.getEnvActivation(), program)
         return cmd
 
@@ -68,7 +184,7 @@ class Plugin(pwem.Plugin):
 
     @classmethod
     def getChaiEnvActivation(cls):
-        return "conda activate chai1-%s" %CHAI1_DEFAULT_VERSION
+        return cls.getEnvActivation()
 
     @classmethod
     def defineBinaries(cls, env):
@@ -88,10 +204,74 @@ class Plugin(pwem.Plugin):
         env.addPackage(CHAI1, version=CHAI1_DEFAULT_VERSION, tar='void.tgz', commands=installCmds, default=True)
 
     @classmethod
+    def runChai(cls, protocol, chai1, args, cwd=None, activationStamp=None):
+        """ Run Chai-1 command from a given protocol.
+
+        :param chai1: executable of the Chai-1 environment, 'chai-lab' or
+                      'python'. It is run directly when the environment is
+                      resolved (see getChaiEnv), otherwise after activating
+                      the environment in a shell.
+        :param activationStamp: optional file touched once the environment
+                                is activated, its modification time splits
+                                the activation from the command itself.
+        """
+        executable = cls.getChaiExecutable(chai1)
+        if executable is not None:
+            if activationStamp:
+                open(activationStamp, 'w').close()
+            protocol.runJob(executable, args,
+                            env=cls.getEnviron(chaiEnv=cls.getChaiEnv()),
+                            cwd=cwd, numberOfMpi=1)
+            return
 
-    def runChai(cls, protocol, chai1, args, cwd=None):
-        """ Run Chai-1 command from a given protocol. """
-        fullProgram = '%s %s && %s' % (cls.getCondaActivationCmd(),
-                                       cls.getChaiEnvActivation(), chai1)
+        activation = '%s %s' % (cls.getCondaActivationCmd(),
+                                cls.getChaiEnvActivation())
+        if activationStamp:
+            activation += ' && touch "%s"' % activationStamp
+        fullProgram = '%s && %s' % (activation, chai1)
         protocol.runJob(fullProgram, args, env=cls.getEnviron(), cwd=cwd,
-                        numberOfMpi=1)
\ No newline at end of file
+                        numberOfMpi=1)
+
+    @classmethod
+    def runFold(cls, protocol, fastaFile, outputDir, activationStamp=None,
+                useEmbeddingCache=False, **options):
+        """ Fold fastaFile into outputDir. The request is served by the
+        persistent chai-lab worker when one is running, otherwise chai-lab
+        is launched as a subprocess (see runChai for activationStamp).
+
+        :param useEmbeddingCache: reuse the cached ESM embeddings of the
+                                  chains, see getEmbeddingCache.
+        :param options: keyword options of chai-lab run_inference, such as
+                        num_trunk_recycles, num_diffn_timesteps,
+                        num_diffn_samples or seed.
+        :return: True if chai-lab ran as a subprocess, False if the worker
+                 served the request.
+        """
+        from .utils import foldArgs
+        from .worker import connect, submitFold
+        conn = connect(cls.getWorkerAddress())
+        if conn is None:
+            # chai-lab fold neither accepts precomputed embeddings nor saves
+            # the PAE/PDE matrices, scripts/chai1_fold.py does both
+            scriptPath = os.path.join(os.path.dirname(__file__), 'scripts',
+                                      'chai1_fold.py')
+            args = [scriptPath, fastaFile, outputDir] + foldArgs(options)
+            if useEmbeddingCache:
+                args += cls.getEmbeddingCacheArgs()
+            cls.runChai(protocol, "python", args, cwd=outputDir,
+                        activationStamp=activationStamp)
+            return True
+        if useEmbeddingCache:
+            options['embedding_cache'] = cls.getEmbeddingCache()
+        with conn:
+            protocol.info(f"Sending {fastaFile} to the chai-lab worker at "
+                          f"{cls.getWorkerAddress()}")
+            submitFold(conn, fastaFile, outputDir, **options)
+        return False
+
+    @classmethod
+    def runChaiScript(cls, protocol, script, args, cwd=None):
+        """ Run one of the scripts in chai1/scripts with the python of the
+        Chai-1 environment. """
+        scriptPath = os.path.join(os.path.dirname(__file__), 'scripts', script)
+        cls.runChai(protocol, 'python', [scriptPath] + list(args), cwd=cwd)
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+On-disk, content-addressed cache of Chai-1 predictions.
+
+Entries are keyed by the canonicalized FASTA content, the chai-lab version
+and the fold options, and hold the models, scores and PAE/PDE matrices of a
+run as written by chai-lab: they are post-processed again, with the
+options of the run, when they are read. The total size is bounded; when it is
+exceeded the least recently used entries are evicted.
+
+:class:`MsaStore` keeps the multiple sequence alignments used by chai-lab,
+one file per chain sequence, so homologous targets and repeated runs share
+them.
+"""
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+
+USED_MARKER = '.last_used'
+# Models, scores and PAE/PDE of a prediction, before post-processing
+CACHED_PATTERNS = ('*.cif', '*.npz', 'pae.*.npy', 'pde.*.npy')
+# Version of the content of the entries, part of the key. Entries of
+# version 1 held post-processed models.
+CACHE_LAYOUT = 2
+# MSA files read and written by chai-lab: <sequence hash>.aligned.pqt
+MSA_SUFFIX = '.aligned.pqt'
+
+
+def readFastaRecords(fastaFile):
+    """ (entity, sequence) of every record of a chai-lab FASTA file, with
+    the entity lowercased and the sequence without blanks. Sequences are
+    uppercased except ligand SMILES, where the case is meaningful. """
+    records = []
+    with open(fastaFile) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('>'):
+                records.append([line[1:].split('|')[0].strip().lower(), ''])
+            elif records:
+                records[-1][1] += ''.join(line.split())
+    return [(entity, seq if entity == 'ligand' else seq.upper())
+            for entity, seq in records]
+
+
+def canonicalFasta(fastaFile):
+    """ FASTA content reduced to what determines the prediction: the entity
+    type of every record and its sequence, see readFastaRecords.
+    Record names and line wrapping do not change the key. """
+    return '\n'.join(f'>{entity}\n{seq}'
+                     for entity, seq in readFastaRecords(fastaFile))
+
+
+def predictionKey(fastaFile, version, options=None):
+    """ Cache key of folding fastaFile with a chai-lab version and options. """
+    content = json.dumps({'fasta': canonicalFasta(fastaFile),
+                          'layout': CACHE_LAYOUT,
+                          'version': version,
+                          'options': options or {}}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _dirSize(path):
+    return sum(os.path.getsize(os.path.join(root, fn))
+               for root, _, files in os.walk(path) for fn in files)
+
+
+class PredictionCache:
+    """ Directory of cache entries, one subdirectory per key. """
+
+    def __init__(self, root, maxSize):
+        """
+        :param root: cache directory, created if needed.
+        :param maxSize: maximum total size in bytes.
+        """
+        self.root = root
+        self.maxSize = maxSize
+        os.makedirs(root, exist_ok=True)
+
+    def _entryPath(self, key):
+        return os.path.join(self.root, key)
+
+    def _touch(self, entry):
+        with open(os.path.join(entry, USED_MARKER), 'w') as f:
+            f.write(str(time.time()))
+
+    def get(self, key, outputDir):
+        """ Copy the files of the entry into outputDir.
+
+        :return: list of copied files, empty when the key is not cached.
+        """
+        entry = self._entryPath(key)
+        if not os.path.isdir(entry):
+            return []
+        os.makedirs(outputDir, exist_ok=True)
+        files = []
+        for fn in sorted(os.listdir(entry)):
+            if fn == USED_MARKER:
+                continue
+            dst = os.path.join(outputDir, fn)
+            shutil.copyfile(os.path.join(entry, fn), dst)
+            files.append(dst)
+        self._touch(entry)
+        return files
+
+    def put(self, key, files):
+        """ Store files under key and evict old entries if needed. """
+        entry = self._entryPath(key)
+        if os.path.isdir(entry):
+            self._touch(entry)
+            return
+        tmpEntry = '%s.%d.tmp' % (entry, os.getpid())
+        os.makedirs(tmpEntry, exist_ok=True)
+        for fn in files:
+            shutil.copyfile(fn, os.path.join(tmpEntry, os.path.basename(fn)))
+        self._touch(tmpEntry)
+        try:
+            os.rename(tmpEntry, entry)
+        except OSError:  # stored meanwhile by another run
+            shutil.rmtree(tmpEntry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in
+        maxSize. """
+        entries = []
+        for key in os.listdir(self.root):
+            entry = self._entryPath(key)
+            marker = os.path.join(entry, USED_MARKER)
+            if key.endswith('.tmp') or not os.path.exists(marker):
+                continue
+            entries.append((os.path.getmtime(marker), _dirSize(entry), entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.maxSize:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def collectOutputs(outputDir, patterns=CACHED_PATTERNS):
+    """ Files of a finished prediction in outputDir that go to the cache. """
+    files = []
+    for pattern in patterns:
+        files.extend(glob.glob(os.path.join(outputDir, pattern)))
+    return sorted(files)
+
+
+def sequenceHash(sequence):
+    """ Hash of a chain sequence, as used by chai-lab to name MSA files. """
+    return hashlib.sha256(sequence.upper().encode()).hexdigest()
+
+
+def _linkOrCopy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:  # another file system
+        shutil.copyfile(src, dst)
+
+
+class MsaStore:
+    """ Directory of chai-lab MSA files shared by all the predictions.
+
+    Files are named as chai-lab expects them (<sequence hash>.aligned.pqt),
+    so a chain seen before reuses its alignment whatever the target. The
+    total size is bounded; the least recently used files are evicted.
+    """
+
+    def __init__(self, root, maxSize):
+        """
+        :param root: store directory, created if needed.
+        :param maxSize: maximum total size in bytes.
+        """
+        self.root = root
+        self.maxSize = maxSize
+        os.makedirs(root, exist_ok=True)
+
+    def _msaPath(self, seqHash):
+        return os.path.join(self.root, seqHash + MSA_SUFFIX)
+
+    def get(self, sequences, msaDir):
+        """ Link the stored MSAs of sequences into msaDir.
+
+        :return: hashes of the sequences found in the store.
+        """
+        found = []
+        for seqHash in sorted({sequenceHash(seq) for seq in sequences}):
+            msaFile = self._msaPath(seqHash)
+            if not os.path.exists(msaFile):
+                continue
+            os.makedirs(msaDir, exist_ok=True)
+            _linkOrCopy(msaFile, os.path.join(msaDir, seqHash + MSA_SUFFIX))
+            os.utime(msaFile)  # mark as recently used
+            found.append(seqHash)
+        return found
+
+    def contains(self, sequence):
+        return os.path.exists(self._msaPath(sequenceHash(sequence)))
+
+    def put(self, msaDir):
+        """ Store the MSA files of msaDir that are not in the store yet and
+        evict old ones if needed. Returns the number of files added. """
+        added = 0
+        for msaFile in glob.glob(os.path.join(msaDir, '*' + MSA_SUFFIX)):
+            dst = os.path.join(self.root, os.path.basename(msaFile))
+            if os.path.exists(dst):
+                os.utime(dst)
+                continue
+            tmpFile = '%s.%d.tmp' % (dst, os.getpid())
+            shutil.copyfile(msaFile, tmpFile)
+            os.replace(tmpFile, dst)
+            added += 1
+        if added:
+            self.evict()
+        return added
+
+    def evict(self):
+        """ Remove the least recently used MSAs until the store fits in
+        maxSize. """
+        files = []
+        for fn in glob.glob(os.path.join(self.root, '*' + MSA_SUFFIX)):
+            try:
+                stat = os.stat(fn)
+            except OSError:  # removed meanwhile by another run
+                continue
+            files.append((stat.st_mtime, stat.st_size, fn))
+        total = sum(size for _, size, _ in files)
+        for _, size, fn in sorted(files):
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            total -= size
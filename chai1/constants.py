@@ -26,8 +26,37 @@
 
 
 CHAI1='chai1'
-CHAI1_ENV_ACTIVATION='conda activate chai1'
 CHAI1_DEFAULT_VERSION='0.6.1'
 CHAI1_ENV_NAME= '%s-%s' %(CHAI1,CHAI1_DEFAULT_VERSION)
+CHAI1_ENV_ACTIVATION='conda activate %s' % CHAI1_ENV_NAME
+CHAI1_WORKER_ADDRESS = 'CHAI1_WORKER_ADDRESS'
+CHAI1_CACHE_DIR = 'CHAI1_CACHE_DIR'
+CHAI1_PREDICTION_CACHE_SIZE = 'CHAI1_PREDICTION_CACHE_SIZE'  # in GB
+CHAI1_MSA_STORE_SIZE = 'CHAI1_MSA_STORE_SIZE'  # in GB
+CHAI1_EMBEDDING_CACHE_SIZE = 'CHAI1_EMBEDDING_CACHE_SIZE'  # in GB
+CHAI1_FASTA_URL = 'CHAI1_FASTA_URL'
+RCSB_FASTA_URL = 'https://www.rcsb.org/fasta/entry/%s'
+CHAI1_FASTA_CACHE_TTL = 'CHAI1_FASTA_CACHE_TTL'  # in hours
+
+# chai-lab fold presets, keyword options of run_inference. 'standard' uses
+# the chai-lab defaults, 'preview' trades accuracy for speed to triage many
+# targets and 'full' spends more compute on the most promising ones.
+FOLD_PRESET_PREVIEW = 0
+FOLD_PRESET_STANDARD = 1
+FOLD_PRESET_FULL = 2
+FOLD_PRESET_CUSTOM = 3
+FOLD_PRESET_NAMES = ['preview', 'standard', 'full', 'custom']
+FOLD_PRESETS = {
+    FOLD_PRESET_PREVIEW: {'num_trunk_recycles': 1,
+                          'num_diffn_timesteps': 50,
+                          'num_diffn_samples': 1},
+    FOLD_PRESET_STANDARD: {'num_trunk_recycles': 3,
+                           'num_diffn_timesteps': 200,
+                           'num_diffn_samples': 5},
+    FOLD_PRESET_FULL: {'num_trunk_recycles': 6,
+                       'num_diffn_timesteps': 500,
+                       'num_diffn_samples': 5},
+}
+
 MYPLUGIN_BINARY = "MYPLUGIN_BINARY"
 MYPLUGIN_HOME = "MYPLUGIN_HOME"
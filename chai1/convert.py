@@ -0,0 +1,578 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Conversion helpers for the mmCIF files predicted by Chai-1.
+
+:func:`readAtomSite` parses the ``_atom_site`` loop into typed NumPy columns
+using the loop header to locate each field, so it works for the files written
+by chai-lab and for the ones downloaded from the Chai-1 server. Like
+:func:`writeLddtCif`, it reads gzip files and CIF members of a server ZIP in
+place, see :func:`openText`.
+
+:func:`writeLddtCif` reads a predicted model once and, in the same pass,
+writes the CIF with per-residue averaged pLDDT in the B-factor column,
+appends the ``_scipion_attributes`` loop and writes the per-residue
+confidence sidecar, a memory-mappable ``.npy`` file. ATOM records are
+processed in bounded chunks and the per-residue averages are computed with
+vectorized reductions. :func:`writeLddtCifs` runs it for several models in
+a process pool. With ``rewrite=False`` the models are left as written by
+chai-lab and only the sidecar is produced; :func:`writeLddtDefattr` turns it
+into a ChimeraX residue attribute file to color them.
+
+The PAE and PDE matrices saved by the fold scripts (see
+scripts/fold_outputs.py) are memory-mapped by :func:`readErrorMatrix` and
+reduced for display by :func:`downsampleMatrix` one block of rows at a time.
+
+:func:`readScores` gathers the chai-lab scores of several models into one
+array per score and :func:`rankModels` orders the models with them.
+"""
+import gzip
+import io
+import itertools
+import os
+import shutil
+import warnings
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from operator import methodcaller
+
+import numpy as np
+
+ATOM_SITE = '_atom_site.'
+ATOM_RECORD = 'ATOM'
+ATOM_RECORDS = (ATOM_RECORD, 'HETATM')
+
+# _atom_site columns used by the plugin
+COL_GROUP = 'group_PDB'
+COL_CHAIN = 'label_asym_id'
+COL_NUMBER = 'label_seq_id'
+COL_NAME = 'label_comp_id'
+COL_BFACTOR = 'B_iso_or_equiv'
+COL_COORDS = ('Cartn_x', 'Cartn_y', 'Cartn_z')
+# (name, _atom_site column, dtype) read by readAtomSite, widths as in the
+# confidence sidecar
+_ATOM_SITE_FIELDS = [('group', COL_GROUP, 'S6'), ('chain', COL_CHAIN, 'S4'),
+                     ('number', COL_NUMBER, 'S8'), ('name', COL_NAME, 'S5'),
+                     ('bfactor', COL_BFACTOR, 'f8')] + \
+                    [(c, c, 'f8') for c in COL_COORDS]
+
+# Number of ATOM records rewritten per vectorized chunk
+CHUNK_SIZE = 65536
+
+GZIP_SUFFIX = '.gz'
+# Default level of the gzip tool: 9 is much slower for about 1% smaller files
+GZIP_LEVEL = 6
+
+LDDT_HEADER = '# LDDT values'
+LDDT_SIDECAR_SUFFIX = '_lddt.npy'
+# One row per residue in the binary confidence sidecar
+LDDT_DTYPE = np.dtype([('chain', 'S4'), ('number', '<i4'), ('name', 'S5'),
+                       ('lddt', '<f4')])
+LDDT_PREFIX = 'LDDT residues:'
+# ChimeraX residue attribute of the per-residue pLDDT, see writeLddtDefattr
+LDDT_ATTRIBUTE = 'lddt'
+LDDT_DEFATTR_SUFFIX = '_lddt.defattr'
+
+PAE = 'pae'
+PDE = 'pde'
+# Rows of an error matrix read at once by downsampleMatrix
+MATRIX_BLOCK_SIZE = 256
+
+# Scalar scores of the chai-lab scores.model_idx_<i>.npz files
+SCORE_AGGREGATE = 'aggregate_score'
+SCORE_PTM = 'ptm'
+SCORE_IPTM = 'iptm'
+SCORE_CLASHES = 'has_inter_chain_clashes'
+SCORE_FIELDS = (SCORE_AGGREGATE, SCORE_PTM, SCORE_IPTM, SCORE_CLASHES)
+
+
+@contextmanager
+def openText(source):
+    """ Text stream for a path, a (zip file, member) pair or an already
+    open stream. ZIP members are read in place, without extracting them,
+    and gzip files (.gz) are decompressed on the fly. """
+    if isinstance(source, tuple):
+        zipName, member = source
+        with zipfile.ZipFile(zipName) as zipRef, zipRef.open(member) as raw:
+            if member.endswith(GZIP_SUFFIX):
+                raw = gzip.GzipFile(fileobj=raw)
+            yield io.TextIOWrapper(raw, encoding='utf-8')
+    elif isinstance(source, (str, os.PathLike)):
+        with _openPath(source, 'r') as f:
+            yield f
+    else:
+        yield source
+
+
+def _openPath(fileName, mode, compressed=None):
+    """ Open fileName in text mode, gzip-compressed if compressed is True or
+    if it is None and fileName ends with .gz """
+    if compressed is None:
+        compressed = isCompressed(fileName)
+    if compressed:
+        return gzip.open(fileName, mode + 't', compresslevel=GZIP_LEVEL,
+                         encoding='utf-8')
+    return open(fileName, mode)
+
+
+def modelName(fileName):
+    """ Base name of a model file without its extensions, e.g.
+    pred.model_idx_0 for pred.model_idx_0.cif or pred.model_idx_0.cif.gz """
+    name = os.path.basename(fileName)
+    if name.endswith(GZIP_SUFFIX):
+        name = name[:-len(GZIP_SUFFIX)]
+    return os.path.splitext(name)[0]
+
+
+def isCompressed(fileName):
+    return os.fspath(fileName).endswith(GZIP_SUFFIX)
+
+
+def _columnIndex(columns, name):
+    if name not in columns:
+        raise Exception(f"Column {ATOM_SITE}{name} not found in the "
+                        f"_atom_site loop")
+    return columns[name]
+
+
+def residueStarts(chain, number):
+    """ Index of the first atom of every residue.
+
+    A new residue starts whenever the chain or the residue number changes
+    between two consecutive atoms.
+    """
+    if len(number) == 0:
+        return np.zeros(0, dtype=np.int64)
+    change = (chain[1:] != chain[:-1]) | (number[1:] != number[:-1])
+    return np.flatnonzero(np.concatenate(([True], change)))
+
+
+def residueMeans(values, starts):
+    """ Average of values over the residues defined by starts. """
+    counts = np.diff(np.append(starts, len(values)))
+    return np.add.reduceat(values, starts) / counts, counts
+
+
+def readAtomSite(source, groups=(ATOM_RECORD,)):
+    """ Read the _atom_site loop of a CIF file into NumPy columns.
+
+    Only the columns below are kept: the records are streamed to the C
+    parser of numpy.loadtxt, which fills typed arrays without building a
+    Python object per field.
+
+    :param source: path of the CIF file, (zip file, member) pair or an open
+                   text stream.
+    :param groups: group_PDB records to keep (ATOM, HETATM).
+    :return: dict with the arrays chain (bytes), number (int), name
+             (bytes), bfactor (float) and coords (float, N x 3). Residue
+             numbers that are not defined ('.') are read as 0.
+    """
+    columns = {}
+    with openText(source) as f:
+        line = ''
+        for line in f:
+            if line.startswith(ATOM_SITE):
+                columns[line.strip()[len(ATOM_SITE):]] = len(columns)
+            elif columns:
+                break
+        if not columns:
+            raise Exception("No _atom_site loop found in the CIF file")
+
+        fields = [(name, _columnIndex(columns, column), dtype)
+                  for name, column, dtype in _ATOM_SITE_FIELDS]
+        fields.sort(key=lambda field: field[1])  # loadtxt keeps file order
+        records = itertools.takewhile(methodcaller('startswith', ATOM_RECORDS),
+                                      itertools.chain([line], f))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # empty loop
+            atoms = np.loadtxt(records, comments=None, ndmin=1,
+                               usecols=[idx for _, idx, _ in fields],
+                               dtype=[(name, dtype) for name, _, dtype in fields])
+
+    atoms = atoms[np.isin(atoms['group'], [g.encode() for g in groups])]
+    number = atoms['number']
+    return {
+        'chain': atoms['chain'],
+        'number': np.where(number == b'.', b'0', number).astype(np.int64),
+        'name': atoms['name'],
+        'bfactor': atoms['bfactor'],
+        'coords': np.stack([atoms[c] for c in COL_COORDS], axis=1),
+    }
+
+
+def residueConfidence(atoms):
+    """ Per-residue averaged B-factor (pLDDT) of the atoms read by
+    :func:`readAtomSite`.
+
+    :return: (aminoAcids, lddtValues) arrays with one entry per residue.
+    """
+    starts = residueStarts(atoms['chain'], atoms['number'])
+    means, _ = residueMeans(atoms['bfactor'], starts)
+    return atoms['name'][starts], means
+
+
+def lddtSidecarPath(cifFile):
+    """ Per-residue confidence sidecar of a model: model_lddt.npy """
+    return os.path.join(os.path.dirname(cifFile),
+                        modelName(cifFile) + LDDT_SIDECAR_SUFFIX)
+
+
+def writeLddtSidecar(fileName, chains, numbers, aminoAcids, lddtValues):
+    """ Write the per-residue confidence of a model as a NumPy structured
+    array (.npy) with the fields of LDDT_DTYPE, one row per residue.
+    Residue numbers that are not defined ('.') are stored as 0. """
+    residues = np.empty(len(lddtValues), dtype=LDDT_DTYPE)
+    residues['chain'] = chains
+    residues['number'] = [0 if n == '.' else int(n) for n in numbers]
+    residues['name'] = aminoAcids
+    residues['lddt'] = lddtValues
+    tmpFile = fileName + '.tmp'
+    with open(tmpFile, 'wb') as f:
+        np.save(f, residues)
+    os.replace(tmpFile, fileName)
+
+
+def readLddtSidecar(fileName, mmap=True):
+    """ Per-residue confidence of a model written by
+    :func:`writeLddtSidecar`. By default the file is memory-mapped, so only
+    the rows that are accessed are read from disk. """
+    return np.load(fileName, mmap_mode='r' if mmap else None)
+
+
+def lddtDefattrPath(cifFile, modelId=None):
+    """ ChimeraX attribute file of a model: model_lddt.defattr, or
+    model_lddt.2.defattr when it is written for ChimeraX model #2 """
+    base, extension = os.path.splitext(LDDT_DEFATTR_SUFFIX)
+    if modelId is not None:
+        base += f'.{modelId}'
+    return os.path.join(os.path.dirname(cifFile),
+                        modelName(cifFile) + base + extension)
+
+
+def writeLddtDefattr(lddtFile, fileName, modelId=None):
+    """ Write the per-residue confidence sidecar lddtFile as a ChimeraX
+    defattr file that assigns the LDDT_ATTRIBUTE residue attribute.
+
+    Residues are matched by chain and number, chai-lab writes the same
+    author and label identifiers. Residues without number (ligands) are
+    skipped. With modelId the residues are specified in that ChimeraX model
+    (#2/A:1), so opening the file with the ChimeraX open command only
+    assigns the attribute to that model.
+    """
+    residues = readLddtSidecar(lddtFile)
+    model = '' if modelId is None else f'#{modelId}'
+    lines = [f'attribute: {LDDT_ATTRIBUTE}', 'recipient: residues',
+             'match mode: any']
+    for chain, number, lddt in zip(residues['chain'].astype(str).tolist(),
+                                   residues['number'].tolist(),
+                                   residues['lddt'].tolist()):
+        if number:
+            lines.append(f'\t{model}/{chain}:{number}\t{lddt:.2f}')
+    tmpFile = fileName + '.tmp'
+    with open(tmpFile, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmpFile, fileName)
+
+
+def writeLddtAttributes(fOut, aminoAcids, lddtValues):
+    """ Append the per-residue LDDT loop read by the viewers. """
+    fOut.write(f"\n{LDDT_HEADER}\n")
+    fOut.write("loop_\n")
+    fOut.write("_scipion_attributes.name\n")
+    fOut.write("_scipion_attributes.recipient\n")
+    fOut.write("scipion_attributes.specifier\n")
+    fOut.write("scipion_attributes.value\n")
+    for cont, (aminoAcid, lddtValue) in enumerate(zip(aminoAcids, lddtValues),
+                                                  start=1):
+        fOut.write(f'{LDDT_PREFIX} {cont} {aminoAcid} {lddtValue}\n')
+
+
+class _LddtRewriter:
+    """ Chunked rewrite of the ATOM records of a single model. """
+
+    def __init__(self, fOut, columns):
+        self.fOut = fOut
+        self.chainCol = _columnIndex(columns, COL_CHAIN)
+        self.numberCol = _columnIndex(columns, COL_NUMBER)
+        self.nameCol = _columnIndex(columns, COL_NAME)
+        self.bfactorCol = _columnIndex(columns, COL_BFACTOR)
+        self.chains = []
+        self.numbers = []
+        self.aminoAcids = []
+        self.lddtValues = []
+
+    def flush(self, rows, final):
+        """ Write every complete residue in rows and return the atoms of
+        the last one when more records of the same residue may follow. """
+        chain = np.array([parts[self.chainCol] for parts in rows])
+        number = np.array([parts[self.numberCol] for parts in rows])
+        starts = residueStarts(chain, number)
+        end = len(rows) if final else starts[-1]
+        if not final:
+            starts = starts[:-1]
+        if len(starts):
+            values = np.array([parts[self.bfactorCol] for parts in rows[:end]],
+                              dtype=np.float64)
+            means, counts = residueMeans(values, starts)
+            self._write(rows, starts, counts, means)
+        return rows[end:]
+
+    def _write(self, rows, starts, counts, means):
+        col = self.bfactorCol
+        lines = []
+        for start, count, mean in zip(starts.tolist(), counts.tolist(),
+                                      means.tolist()):
+            value = f"{mean:.10f}"
+            for parts in rows[start:start + count]:
+                parts[col] = value
+                lines.append(' '.join(parts))
+            first = rows[start]
+            self.chains.append(first[self.chainCol])
+            self.numbers.append(first[self.numberCol])
+            self.aminoAcids.append(first[self.nameCol])
+            self.lddtValues.append(mean)
+        lines.append('')
+        self.fOut.write('\n'.join(lines))
+
+
+def writeLddtCif(inFile, outFile, lddtFile=None, chunkSize=CHUNK_SIZE,
+                 rewrite=True):
+    """ Rewrite a predicted model with per-residue averaged pLDDT values.
+
+    :param inFile: CIF file produced by chai-lab or the Chai-1 server, as a
+                   path or a (zip file, member) pair.
+    :param outFile: rewritten CIF, it may be the same path as inFile. It is
+                    gzip-compressed when it ends with .gz
+    :param lddtFile: optional binary per-residue sidecar, see
+                     :func:`writeLddtSidecar`.
+    :param chunkSize: maximum number of ATOM records kept in memory.
+    :param rewrite: if False the model is copied to outFile unchanged
+                    (extracted or compressed as needed), or only read when
+                    outFile is inFile, see :func:`_writeLddtSidecarOnly`.
+    :return: (aminoAcids, lddtValues) lists with one entry per residue.
+    """
+    if not rewrite:
+        return _writeLddtSidecarOnly(inFile, outFile, lddtFile)
+    columns = {}
+    rows = []
+    rewriter = None
+    blankLines = ''
+    tmpFile = outFile + '.tmp'
+    try:
+        with openText(inFile) as fIn, \
+                _openPath(tmpFile, 'w', isCompressed(outFile)) as fOut:
+            for line in fIn:
+                if line.startswith('ATOM '):
+                    rows.append(line.split())
+                    if len(rows) >= chunkSize:
+                        if rewriter is None:
+                            rewriter = _LddtRewriter(fOut, columns)
+                        rows = rewriter.flush(rows, final=False)
+                    continue
+                if rows:
+                    if rewriter is None:
+                        rewriter = _LddtRewriter(fOut, columns)
+                    rows = rewriter.flush(rows, final=True)
+                if line.startswith(LDDT_HEADER):
+                    break  # attributes of a previous rewrite, replaced below
+                if not line.strip():
+                    # kept back, so the blank line before a previous LDDT
+                    # loop is not repeated on every rewrite
+                    blankLines += line
+                    continue
+                if line.startswith(ATOM_SITE):
+                    columns[line.strip()[len(ATOM_SITE):]] = len(columns)
+                fOut.write(blankLines + line)
+                blankLines = ''
+            if rows:
+                if rewriter is None:
+                    rewriter = _LddtRewriter(fOut, columns)
+                rewriter.flush(rows, final=True)
+            if rewriter is None:
+                raise Exception(f"No ATOM records found in {inFile}")
+            writeLddtAttributes(fOut, rewriter.aminoAcids,
+                                rewriter.lddtValues)
+    except Exception:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+        raise
+    os.replace(tmpFile, outFile)
+    if lddtFile:
+        writeLddtSidecar(lddtFile, rewriter.chains, rewriter.numbers,
+                         rewriter.aminoAcids, rewriter.lddtValues)
+    return rewriter.aminoAcids, rewriter.lddtValues
+
+
+def _teeLines(lines, fOut):
+    """ Yield lines while writing them to fOut. """
+    for line in lines:
+        fOut.write(line)
+        yield line
+
+
+def _writeLddtSidecarOnly(inFile, outFile, lddtFile=None):
+    """ :func:`writeLddtCif` without rewrite: the per-residue pLDDT is read
+    with :func:`readAtomSite`. Unless outFile is inFile, the model is copied
+    unchanged to outFile in the same pass, so it is read (and decompressed)
+    only once. """
+    tmpFile = outFile + '.tmp'
+    try:
+        if outFile == inFile:
+            atoms = readAtomSite(inFile)
+        else:
+            with openText(inFile) as fIn, \
+                    _openPath(tmpFile, 'w', isCompressed(outFile)) as fOut:
+                atoms = readAtomSite(_teeLines(fIn, fOut))
+                shutil.copyfileobj(fIn, fOut)  # what follows _atom_site
+        if not len(atoms['number']):
+            raise Exception(f"No ATOM records found in {inFile}")
+    except Exception:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+        raise
+    if outFile != inFile:
+        os.replace(tmpFile, outFile)
+    starts = residueStarts(atoms['chain'], atoms['number'])
+    lddtValues, _ = residueMeans(atoms['bfactor'], starts)
+    aminoAcids = atoms['name'][starts]
+    if lddtFile:
+        writeLddtSidecar(lddtFile, atoms['chain'][starts],
+                         atoms['number'][starts], aminoAcids, lddtValues)
+    return aminoAcids.astype(str).tolist(), lddtValues.tolist()
+
+
+def _writeLddtCifJob(job, rewrite):
+    """ Run a job of :func:`writeLddtCifs` and return its sidecar path, so
+    a pool worker does not send the per-residue lists back. """
+    inFile, outFile, lddtFile = job
+    writeLddtCif(inFile, outFile, lddtFile, rewrite=rewrite)
+    return lddtFile
+
+
+def usableCpus():
+    """ Number of CPUs this process may run on. """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS
+        return os.cpu_count() or 1
+
+
+def writeLddtCifs(jobs, numberOfWorkers=1, rewrite=True):
+    """ Run :func:`writeLddtCif` for several models.
+
+    :param jobs: list of (inFile, outFile, lddtFile) tuples.
+    :param numberOfWorkers: size of the process pool. It is capped by the
+                            number of jobs and of usable CPUs, and the jobs
+                            run serially in this process when that leaves
+                            a single worker.
+    :param rewrite: see :func:`writeLddtCif`.
+    :return: list with the sidecar path of every job, in the same order as
+             jobs.
+    """
+    func = partial(_writeLddtCifJob, rewrite=rewrite)
+    numberOfWorkers = min(numberOfWorkers, len(jobs), usableCpus())
+    if numberOfWorkers <= 1:
+        return [func(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=numberOfWorkers) as executor:
+        return list(executor.map(func, jobs))
+
+
+def _modelFilePath(cifFile, prefix, extension):
+    name = modelName(cifFile)
+    if name.startswith('pred.'):
+        name = name[len('pred.'):]
+    return os.path.join(os.path.dirname(cifFile), f'{prefix}.{name}{extension}')
+
+
+def errorMatrixPath(cifFile, kind=PAE):
+    """ PAE or PDE matrix of a model: pred.model_idx_0.cif has its PAE in
+    pae.model_idx_0.npy. """
+    return _modelFilePath(cifFile, kind, '.npy')
+
+
+def scoresPath(cifFile):
+    """ chai-lab scores of a model: scores.model_idx_0.npz """
+    return _modelFilePath(cifFile, 'scores', '.npz')
+
+
+def readErrorMatrix(fileName, mmap=True):
+    """ N x N error matrix of a model, memory-mapped by default. """
+    return np.load(fileName, mmap_mode='r' if mmap else None)
+
+
+def downsampleMatrix(matrix, maxSize):
+    """ Average matrix over square windows so that no side is longer than
+    maxSize. Only MATRIX_BLOCK_SIZE rows (or one window) are read from a
+    memory-mapped matrix at a time.
+
+    :return: (reduced matrix, window) with float32 values.
+    """
+    n, m = matrix.shape
+    window = max(1, int(np.ceil(max(n, m) / maxSize)))
+    colStarts = np.arange(0, m, window)
+    colCounts = np.diff(np.append(colStarts, m))
+    rowsPerBlock = window * max(1, MATRIX_BLOCK_SIZE // window)
+    rows = []
+    for start in range(0, n, rowsPerBlock):
+        block = np.asarray(matrix[start:start + rowsPerBlock], dtype=np.float32)
+        rowStarts = np.arange(0, len(block), window)
+        rowCounts = np.diff(np.append(rowStarts, len(block)))
+        sums = np.add.reduceat(np.add.reduceat(block, rowStarts, axis=0),
+                               colStarts, axis=1)
+        rows.append(sums / np.outer(rowCounts, colCounts))
+    return np.concatenate(rows), window
+
+
+def readScores(scoreFiles):
+    """ Scalar scores (SCORE_FIELDS) of several models.
+
+    :param scoreFiles: chai-lab scores .npz file of every model.
+    :return: dict with one array per score and one entry per model. Scores
+             that are missing are NaN, and clashes False.
+    """
+    scores = np.full((len(SCORE_FIELDS), len(scoreFiles)), np.nan)
+    for i, fn in enumerate(scoreFiles):
+        if not os.path.exists(fn):
+            continue
+        with np.load(fn) as data:
+            for j, field in enumerate(SCORE_FIELDS):
+                if field in data:
+                    scores[j, i] = np.asarray(data[field], dtype=np.float64).ravel()[0]
+    result = dict(zip(SCORE_FIELDS, scores))
+    result[SCORE_CLASHES] = result[SCORE_CLASHES] > 0
+    return result
+
+
+def rankModels(scores):
+    """ Model indexes from best to worst: models without inter-chain
+    clashes first, then by decreasing aggregate score (0.2 pTM + 0.8 ipTM
+    in chai-lab). Models without scores go last. """
+    aggregate = scores[SCORE_AGGREGATE]
+    return np.lexsort((-np.nan_to_num(aggregate, nan=-np.inf),
+                       scores[SCORE_CLASHES], np.isnan(aggregate)))
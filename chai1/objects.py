@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Scipion objects of the Chai-1 plugin.
+"""
+import pwem.objects as emobj
+
+
+class Chai1PAE(emobj.EMFile):
+    """ Predicted aligned error of a Chai-1 model: N x N tokens matrix in
+    Angstroms saved as a NumPy .npy file. """
+
+    def getMatrix(self, mmap=True):
+        """ The matrix, memory-mapped unless mmap is False. """
+        from .convert import readErrorMatrix
+        return readErrorMatrix(self.getFileName(), mmap=mmap)
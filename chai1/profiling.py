@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Wall time, CPU time and peak memory of the phases of a Chai-1 run.
+
+Every phase is measured with :func:`measurePhase` and stored as
+``{'wall': s, 'cpu': s, 'peakRss': MB, 'rssOf': RSS_PROCESS|RSS_SUBPROCESS}``.
+CPU time is the one of the calling thread plus the one of the subprocesses
+that finished during the phase (chai-lab), so phases running in parallel
+steps do not count each other.
+
+Peak RSS depends on where the phase does its work:
+
+- RSS_PROCESS: the resident memory of this process is sampled every
+  RSS_INTERVAL seconds during the phase and the largest sample is kept, so
+  a phase is not charged with the peak of an earlier one. Where the current
+  RSS cannot be read (no /proc) the high-water mark of the process is used.
+- RSS_SUBPROCESS: for the phase that runs chai-lab in a subprocess, the
+  peak of the largest subprocess finished so far (RUSAGE_CHILDREN). On
+  Linux a subprocess inherits the high-water mark of this process when it
+  is forked, so the value is never below the peak of this process.
+"""
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_FILE = 'profile.json'
+RSS_PROCESS = 'process'
+RSS_SUBPROCESS = 'subprocess'
+# Seconds between two samples of the resident memory of a phase
+RSS_INTERVAL = 0.05
+
+
+def _maxRss(who):
+    """ High-water mark (MB) of resident memory of RUSAGE_SELF or
+    RUSAGE_CHILDREN. """
+    # ru_maxrss is in bytes on macOS and in KB everywhere else
+    unit = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss / unit
+
+
+def _currentRss():
+    """ Current resident memory (MB) of this process, or None if it cannot
+    be read. """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+
+class _RssSampler:
+    """ Largest resident memory of this process while it runs. """
+
+    def __init__(self):
+        self.peak = _currentRss()
+        self._done = threading.Event()
+        self._thread = None
+        if self.peak is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._done.wait(RSS_INTERVAL):
+            self.peak = max(self.peak, _currentRss() or 0)
+
+    def stop(self):
+        if self._thread is None:
+            return _maxRss(resource.RUSAGE_SELF)
+        self._done.set()
+        self._thread.join()
+        return max(self.peak, _currentRss() or 0)
+
+
+def _childrenCpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextmanager
+def measurePhase():
+    """ Yield a dict that is filled with the usage of the block on exit,
+    with the peak RSS of this process (RSS_PROCESS). """
+    usage = {}
+    wall, cpu, childrenCpu = time.perf_counter(), time.thread_time(), _childrenCpu()
+    sampler = _RssSampler()
+    try:
+        yield usage
+    finally:
+        usage['wall'] = time.perf_counter() - wall
+        usage['cpu'] = (time.thread_time() - cpu) + (_childrenCpu() - childrenCpu)
+        usage['peakRss'] = sampler.stop()
+        usage['rssOf'] = RSS_PROCESS
+
+
+def setSubprocessRss(usage):
+    """ Report in usage the peak RSS of the subprocess that did the work of
+    the phase (RSS_SUBPROCESS), once it has finished. """
+    usage['peakRss'] = _maxRss(resource.RUSAGE_CHILDREN)
+    usage['rssOf'] = RSS_SUBPROCESS
+    return usage
+
+
+def runMeasured(func, *args):
+    """ Run func(*args) and return (result, usage). It is meant to be
+    submitted to a process pool, so the usage is the one of the worker. """
+    with measurePhase() as usage:
+        result = func(*args)
+    return result, usage
+
+
+def readProfile(fileName):
+    if not os.path.exists(fileName):
+        return {}
+    with open(fileName) as f:
+        return json.load(f)
+
+
+def addPhase(fileName, phase, usage):
+    """ Add (or replace) the usage of phase in the JSON profile fileName. """
+    profile = readProfile(fileName)
+    profile[phase] = usage
+    tmpFile = fileName + '.tmp'
+    with open(tmpFile, 'w') as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmpFile, fileName)
+    return profile
+
+
+def formatProfile(profile):
+    """ One line per phase: wall time, CPU time and peak RSS. """
+    lines = []
+    for phase, usage in profile.items():
+        of = (" (chai-lab subprocess)"
+              if usage.get('rssOf') == RSS_SUBPROCESS else "")
+        lines.append(f"{phase}: {usage['wall']:.1f} s wall, "
+                     f"{usage['cpu']:.1f} s CPU, "
+                     f"{usage['peakRss']:.0f} MB peak RSS{of}")
+    return lines
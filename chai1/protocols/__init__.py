@@ -4,3 +4,4 @@
 # Find documentation here: https://scipion-em.github.io/docs/docs/developer/creating-a-protocol
 # **************************************************************************
 from .protocol_chai1 import Chai1Protocol
+from .protocol_chai1_batch import Chai1BatchProtocol
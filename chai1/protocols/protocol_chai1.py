@@ -30,16 +30,151 @@
 Describe your python module here:
 This module will provide the traditional Hello world example
 """
+import glob
 import os
-import subprocess
+from functools import partial
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pwem.objects as emobj
-import requests
-from pyworkflow.protocol.params import EnumParam, StringParam, FileParam
+from pyworkflow.object import String, Float, Integer, Boolean
+from pyworkflow.protocol.params import (EnumParam, StringParam, FileParam,
+                                        BooleanParam, IntParam, LEVEL_ADVANCED)
 from pwem.protocols import EMProtocol
-from collections import defaultdict
-import zipfile
+import numpy as np
+from pyworkflow.protocol.constants import STEPS_PARALLEL
 import json
 from .. import Plugin
+from ..cache import (predictionKey, collectOutputs, readFastaRecords,
+                     sequenceHash)
+from ..constants import (CHAI1_DEFAULT_VERSION, FOLD_PRESETS,
+                         FOLD_PRESET_NAMES, FOLD_PRESET_STANDARD,
+                         FOLD_PRESET_CUSTOM)
+from ..convert import (writeLddtCif, writeLddtCifs, lddtSidecarPath,
+                       readLddtSidecar, errorMatrixPath, scoresPath,
+                       readScores, rankModels,
+                       SCORE_AGGREGATE, SCORE_PTM, SCORE_IPTM, SCORE_CLASHES,
+                       GZIP_SUFFIX)
+from ..objects import Chai1PAE
+from ..profiling import (PROFILE_FILE, measurePhase, runMeasured, addPhase,
+                         setSubprocessRss,
+                         readProfile, formatProfile)
+from ..utils import (reformatFastaFile, fileChecksum, modelIndex, targetName,
+                     readServerArchive)
+
+# Output attribute of every fold option
+FOLD_ATTRIBUTES = {'num_trunk_recycles': '_numTrunkRecycles',
+                   'num_diffn_timesteps': '_numDiffnTimesteps',
+                   'num_diffn_samples': '_numDiffnSamples',
+                   'seed': '_seed'}
+
+
+# Output attribute of every chai-lab score
+SCORE_ATTRIBUTES = {SCORE_AGGREGATE: '_aggregateScore',
+                    SCORE_PTM: '_ptm',
+                    SCORE_IPTM: '_iptm'}
+
+
+def setModelAttributes(obj, cifFile):
+    """ Record the model index, the per-residue confidence sidecar with its
+    mean pLDDT and the PAE of the model in cifFile in the output obj. The
+    attributes are always set, empty when the file does not exist, since
+    they are the columns of the output sets. """
+    obj._modelIndex = Integer(modelIndex(cifFile))
+    lddtFile = lddtSidecarPath(cifFile)
+    obj._lddtFile = String()
+    obj._meanPlddt = Float()
+    if os.path.exists(lddtFile):
+        obj._lddtFile.set(lddtFile)
+        lddt = readLddtSidecar(lddtFile)['lddt']
+        if len(lddt):
+            obj._meanPlddt.set(float(lddt.mean()))
+    paeFile = errorMatrixPath(cifFile)
+    obj._pae = Chai1PAE(filename=paeFile if os.path.exists(paeFile) else None)
+
+
+def setScoreAttributes(obj, scores, i, rank):
+    """ Record the scores of model i, see convert.readScores, and its rank
+    (0 is the best model) in the output obj. Missing scores are empty. """
+    for field, attrName in SCORE_ATTRIBUTES.items():
+        value = scores[field][i]
+        setattr(obj, attrName, Float(None if np.isnan(value) else float(value)))
+    obj._hasClashes = Boolean(bool(scores[SCORE_CLASHES][i]))
+    obj._rank = Integer(rank)
+
+
+def addFoldParams(form, condition=None):
+    """ Fold preset and chai-lab options, shared by the Chai-1 protocols.
+
+    :param condition: optional condition of the params in the form.
+    """
+    custom = 'preset==%d' % FOLD_PRESET_CUSTOM
+    if condition:
+        custom = '%s and %s' % (condition, custom)
+    standard = FOLD_PRESETS[FOLD_PRESET_STANDARD]
+    form.addParam('preset', EnumParam, condition=condition,
+                  choices=FOLD_PRESET_NAMES, default=FOLD_PRESET_STANDARD,
+                  label='Fold preset',
+                  help='preview: 1 trunk recycle, 50 diffusion timesteps and '
+                       'a single model, to triage many targets quickly.\n'
+                       'standard: chai-lab defaults, 3 trunk recycles, 200 '
+                       'diffusion timesteps and 5 models.\n'
+                       'full: 6 trunk recycles and 500 diffusion timesteps.\n'
+                       'custom: set the options below.')
+    form.addParam('numTrunkRecycles', IntParam, condition=custom,
+                  default=standard['num_trunk_recycles'],
+                  expertLevel=LEVEL_ADVANCED, label='Trunk recycles',
+                  help='Number of recycles of the chai-lab trunk.')
+    form.addParam('numDiffnTimesteps', IntParam, condition=custom,
+                  default=standard['num_diffn_timesteps'],
+                  expertLevel=LEVEL_ADVANCED, label='Diffusion timesteps',
+                  help='Number of timesteps of the diffusion module.')
+    form.addParam('numDiffnSamples', IntParam, condition=custom,
+                  default=standard['num_diffn_samples'],
+                  expertLevel=LEVEL_ADVANCED, label='Models',
+                  help='Number of models sampled by the diffusion module.')
+    form.addParam('seed', IntParam, condition=condition, allowsNull=True,
+                  expertLevel=LEVEL_ADVANCED, label='Random seed',
+                  help='Seed of chai-lab, set it to reproduce a prediction.')
+
+
+def addPostProcessParams(form, condition=None):
+    """ Post-processing options of the predicted models, shared by the
+    Chai-1 protocols.
+
+    :param condition: optional condition of the params in the form.
+    """
+    form.addParam('rewriteModels', BooleanParam, default=False,
+                  condition=condition, expertLevel=LEVEL_ADVANCED,
+                  label='Write the LDDT into the models',
+                  help='Write the per-residue pLDDT into the B-factor '
+                       'column and append the LDDT loop read by older '
+                       'viewers. Not needed by the Chai-1 viewers, which '
+                       'read the per-residue confidence sidecar; when '
+                       'off the chai-lab models are kept untouched.')
+
+
+def getFoldOptions(protocol):
+    """ chai-lab run_inference options selected in the form of protocol. """
+    preset = protocol.preset.get()
+    if preset == FOLD_PRESET_CUSTOM:
+        options = {'num_trunk_recycles': protocol.numTrunkRecycles.get(),
+                   'num_diffn_timesteps': protocol.numDiffnTimesteps.get(),
+                   'num_diffn_samples': protocol.numDiffnSamples.get()}
+    else:
+        options = dict(FOLD_PRESETS[preset])
+    if protocol.seed.get() is not None:
+        options['seed'] = protocol.seed.get()
+    return options
+
+
+def setFoldAttributes(obj, options):
+    """ Record the fold options of a prediction in the output obj. """
+    for key, attrName in FOLD_ATTRIBUTES.items():
+        if options.get(key) is not None:
+            setattr(obj, attrName, Integer(options[key]))
 
 
 class Chai1Protocol(EMProtocol):
@@ -51,10 +186,26 @@ class Chai1Protocol(EMProtocol):
     IMPORT_FASTA=0
     IMPORT_PDBID=1
 
+    FORMAT_CIF = 0
+    FORMAT_CIF_GZ = 1
+
+    IMPORTED_CHECKSUMS = 'imported_archives.txt'
+    MSA_DIR = 'msas'
+    MSA_INFO = 'msas.json'
+    MODEL_PATTERN = 'pred.model_idx_%d.cif'
+
+    stepsExecutionMode = STEPS_PARALLEL
+
     _label = 'Chai-1'
 
     def __init__(self, **args):
         EMProtocol.__init__(self, **args)
+        self.clusteringSummary = String()
+        self.foldOptions = String()  # JSON options of chai-lab, see getFoldOptions
+        self.profile = String()  # JSON usage per phase, see profiling.py
+        self._pool = None
+        self._poolLock = threading.Lock()
+        self._profileLock = threading.Lock()
 
 
 
@@ -82,331 +233,503 @@ class Chai1Protocol(EMProtocol):
                       condition='source==%d' % self.IMPORT_FASTA,
                       label='Introduce Fasta File')
 
+        form.addParam('useCache', BooleanParam, default=True,
+                      condition='runserver==%d' % self.RUN_LOCALLY,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Reuse cached predictions',
+                      help='Look up the prediction cache (CHAI1_CACHE_DIR) '
+                           'before running chai-lab. The cache is keyed by '
+                           'the sequences, the chai-lab version and the fold '
+                           'options; a hit copies the stored models into this '
+                           'run without using the GPU.')
+
+        form.addParam('useMsaServer', BooleanParam, default=False,
+                      condition='runserver==%d' % self.RUN_LOCALLY,
+                      label='Compute MSAs on the ColabFold server',
+                      help='When some protein chain has no MSA in the shared '
+                           'MSA store (CHAI1_CACHE_DIR/msas), chai-lab '
+                           'aligns the chains with the ColabFold MMseqs2 '
+                           'server. The new MSAs are added to the store.')
+        form.addParam('useMsaStore', BooleanParam, default=True,
+                      condition='runserver==%d' % self.RUN_LOCALLY,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Reuse stored MSAs',
+                      help='Give chai-lab the MSAs of the shared store for '
+                           'the protein chains of the input. They are '
+                           'found by sequence, so any previous target with '
+                           'the same chain provides it.')
+
+        form.addParam('useEmbeddingCache', BooleanParam, default=True,
+                      condition='runserver==%d' % self.RUN_LOCALLY,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Reuse cached ESM embeddings',
+                      help='Keep the ESM embedding of every protein chain '
+                           'in CHAI1_CACHE_DIR/embeddings, so identical '
+                           'chains of this and later runs are not embedded '
+                           'again. The cache size is limited by '
+                           'CHAI1_EMBEDDING_CACHE_SIZE (GB).')
+
+        addFoldParams(form, condition='runserver==%d' % self.RUN_LOCALLY)
+
+        form.addParam('topModels', IntParam, default=0,
+                      condition='runserver==%d' % self.RUN_LOCALLY,
+                      label='Register the best models only',
+                      help='Number of models registered as output, ranked '
+                           'by the chai-lab aggregate score (0.2 pTM + 0.8 '
+                           'ipTM) with the models with inter-chain clashes '
+                           'last. 0 registers all the models.')
+
+        form.addParam('outputFormat', EnumParam, default=self.FORMAT_CIF,
+                      label='Output format',
+                      choices=['mmCIF', 'Compressed mmCIF (.cif.gz)'],
+                      help='Format of the registered models. Compressed '
+                           'models take several times less disk space; the '
+                           'pLDDT is kept in the B-factor column and the '
+                           'per-residue values in the model sidecar. The '
+                           'Chai-1 viewers and ChimeraX read them directly, '
+                           'other programs may need a plain mmCIF.')
+        addPostProcessParams(form)
+
         form.addParam('serverfile', FileParam,
                       condition='runserver==%d' % self.RUN_SERVER,
                       label='Import File/Folder',
                       help='Import file/folder with the predictions downloaded '
-                           'from Chai-1 server')
+                           'from Chai-1 server. It can be a ZIP file, a folder '
+                           'with ZIP files or a glob pattern (e.g. '
+                           'downloads/*.zip). Each archive is registered as a '
+                           'separate set of atomic structures.')
+
+        form.addParallelSection(threads=4, mpi=0)
 
     def _insertAllSteps(self):
         runserver=self.runserver.get()
         source=self.source.get()
         if runserver == self.RUN_LOCALLY:
-            if source==self.IMPORT_FASTA:
-                 self._insertFunctionStep('_predictStructure')
-            elif source==self.IMPORT_PDBID:
-               self._insertFunctionStep('_downloadFastaFile')
-               self._insertFunctionStep('_predictStructure')
+            if source==self.IMPORT_PDBID:
+               self._insertFunctionStep('_downloadFastaFile', needsGPU=False)
+            foldId = self._insertFunctionStep('_predictStructure')
+            # One post-processing step per model, they can run in parallel
+            postIds = [self._insertFunctionStep('_postProcessModelStep', i,
+                                                prerequisites=[foldId],
+                                                needsGPU=False)
+                       for i in range(getFoldOptions(self)['num_diffn_samples'])]
+            self._insertFunctionStep('_registerOutputStep',
+                                     prerequisites=postIds, needsGPU=False)
         elif runserver == self.RUN_SERVER:
             serverfile=self.serverfile.get()
-            self._insertFunctionStep('_getModelFromCIF', serverfile)
+            self._insertFunctionStep('_getModelFromCIF', serverfile,
+                                     needsGPU=False)
 
     def _getModelFromCIF(self, serverfile):
-        temp_Dir = self._getExtraPath()  # Ruta temporal donde se extraerán los archivos
-        os.makedirs(temp_Dir, exist_ok=True)  # Asegúrate de que el directorio existe
-        outFileNames = []
-        try:
-            # ABRIR ARCHIVO .ZIP Y OBTENER LA INFORMACIÓN QUE NECESITAMOS.
-            with zipfile.ZipFile(serverfile, 'r') as zip_ref:
-                # EXTRAER  ARCHIVOS .CIF DEL .ZIP FILE
-
-                cif_files = [file for file in zip_ref.namelist() if file.endswith('.cif')]
-
-                if not cif_files:
-                    raise Exception(f"No se encontraron archivos .cif en el archivo ZIP: {serverfile}")
-
-                # Extraer únicamente los archivos .cif al directorio temporal
-                extracted_files = []
-                for cif_file in cif_files:
-                    extracted_path = zip_ref.extract(cif_file, temp_Dir)
-                    extracted_files.append(extracted_path)
-                    print(f"Archivo extraído: {extracted_path}")
-
-                for i, cif_file in enumerate(extracted_files, start=1):
-                    amino_acids, average_lddt_values = self.process_cif_file(cif_file)
-                    with open(cif_file, 'r') as f:
-                        lines = f.readlines()
-
-                    # Modificar las líneas que comienzan con 'ATOM'
-                    atom_index = 0
-                    new_lines = []
-                    for line in lines:
-                        if line.startswith('ATOM '):
-                            parts = line.split()
-                            number = int(parts[8])
-                            if number == atom_index + 1:
-                                atom_index = atom_index
-                            else:
-                                atom_index = atom_index + 1
-                            parts[
-                                13] = f"{average_lddt_values[atom_index]:.10f}"  # Cambiar el valor 1.00 por average_lddt_values
-                            new_line = ' '.join(parts) + '\n'
-                            new_lines.append(new_line)
-                        else:
-                            new_lines.append(line)
-
-                    # Escribir el contenido modificado de nuevo en el archivo
-                    with open(cif_file, 'w') as f:
-                        f.writelines(new_lines)
-
-                    with open(cif_file, 'a') as f:
-                        f.write("\n# LDDT values\n")
-                        f.write("loop_\n")
-                        f.write("_scipion_attributes.name\n")
-                        f.write("_scipion_attributes.recipient\n")
-                        f.write("scipion_attributes.specifier\n")
-                        f.write("scipion_attributes.value\n")
-                        cont = 1
-                        for index, (amino_acid, lddt_value) in enumerate(zip(amino_acids, average_lddt_values),
-                                                                         start=1):
-                            f.write(f'LDDT residues: {cont} {amino_acid} {lddt_value}\n')
-                            cont = cont + 1
-
-                lddt_files = []
-                for i, cif_files in enumerate(extracted_files, start=1):
-                    amino_acids, average_lddt_values = self.process_cif_file(cif_files)
-                    file_name = self._getPath(f'extra/lddt_{i - 1}.txt')
-                    cont = 1
-                    with open(file_name, 'w') as f:
-                        for amino_acid, lddt_value in zip(amino_acids, average_lddt_values):
-                            f.write(f'LDDT  {amino_acid}  {lddt_value:.8f}\n')
-                            cont = cont + 1
-                        print(f'Archivo {file_name} guardado correctamente.')
-
-                    lddt_files.append(file_name)
-
-                # OBTENER RANKING SCORES
-                json_files = [file for file in zip_ref.namelist() if file.endswith('.json') and 'summary' in file]
-
-                if not json_files:
-                    raise Exception(f"Not .json files found in the ZIP file: {serverfile}")
-                ranking_scores = []
-                for json_file in json_files:
-                    # Leer el contenido del archivo JSON
-                    with zip_ref.open(json_file) as file:
-                        data = json.load(file)  # Cargar el JSON como diccionario
-                        if 'ranking_score' in data:
-                            ranking_scores.append(data['ranking_score'])
-
-                # Crear la información para el summary
-                self.clusteringSummary = String()
-                clusteringSummary = ''
-                for i in range(len(ranking_scores)):
-                    msg = '| MODEL ' + str(i) + ' has a ranking score of ' + str(ranking_scores[i])
-                    clusteringSummary += msg
-                self.clusteringSummary.set(clusteringSummary)
-                self._store(self.clusteringSummary)
-                print(f"{clusteringSummary}")
-
-            files = glob.glob(os.path.join(temp_Dir, "*.cif"))
-
-            if not files:
-                raise Exception("No atomic model selected. No valid .cif files were extracted.")
-
-        except zipfile.BadZipFile:
-            raise Exception(f"El archivo proporcionado no es un ZIP válido: {serverfile}")
-        except FileNotFoundError:
-            raise Exception(f"No se encontró el archivo ZIP: {serverfile}")
-        except Exception as e:
-            raise Exception(f"Error inesperado: {e}")
+        """ Import the predictions downloaded from the Chai-1 server. serverfile
+        may be a ZIP file, a folder with ZIP files or a glob pattern. Archives
+        whose checksum was already imported by a Chai-1 run of the project are
+        skipped. """
+        archives = self._getServerArchives(serverfile)
+        if not archives:
+            raise Exception(f"No se encontraron archivos ZIP en: {serverfile}")
+
+        imported = self._readImportedChecksums()
+        with ThreadPoolExecutor(max_workers=self.numberOfThreads.get()) as executor:
+            checksums = list(executor.map(fileChecksum, archives))
+
+        runName = os.path.basename(self.getWorkingDir())
+        names = {name for run, name in imported.values() if run == runName}
+        jobs = []
+        newArchives = []
+        for archive, checksum in zip(archives, checksums):
+            if checksum in imported:
+                run, name = imported[checksum]
+                self.info(f"{archive} ya ha sido importado ({name} en {run}), "
+                          f"se omite.")
+                continue
+            name = targetName(archive)
+            while name in names:
+                name += '_'
+            names.add(name)
+            imported[checksum] = (runName, name)
+            cifMembers, scores = readServerArchive(archive)
+            outputDir = self._getExtraPath(name)
+            os.makedirs(outputDir, exist_ok=True)
+            # Los modelos se leen directamente del ZIP, sin extraerlos
+            outFiles = [self._getOutputFile(os.path.join(outputDir,
+                                                         os.path.basename(member)))
+                        for member in cifMembers]
+            jobs.extend(self._modelJobs([(archive, member) for member in cifMembers],
+                                        outFiles))
+            newArchives.append((name, checksum, outFiles, scores))
+
+        if not newArchives:
+            self.info("Todos los archivos ZIP ya habían sido importados.")
+            return
+
+        with self._profilePhase('postProcess'):
+            self._postProcessModels(jobs)
+
+        with self._profilePhase('registration'):
+            self._registerServerOutputs(newArchives)
+        self._storeProfile()
+
+    def _registerServerOutputs(self, newArchives):
+        """ One set of atomic structures per imported archive. """
+        # Crear la información para el summary
+        clusteringSummary = self.clusteringSummary.get() or ''
+        outputs = {}
+        for name, checksum, outFiles, scores in newArchives:
+            atomStructs = self._createSetOfPDBs(suffix='_' + name)
+            for i, (outFile, score) in enumerate(zip(outFiles, scores)):
+                atomStruct = emobj.AtomStruct(filename=outFile)
+                atomStruct._rankingScore = Float(score)
+                setModelAttributes(atomStruct, outFile)
+                atomStructs.append(atomStruct)
+                if score is not None:
+                    clusteringSummary += (f'| {name} MODEL {i} has a ranking '
+                                          f'score of {score}')
+            atomStructs.write()
+            outputs['output_' + name] = atomStructs
+        self.clusteringSummary.set(clusteringSummary)
+        print(f"{clusteringSummary}")
+        self._defineOutputs(**outputs)
+        self._store(self.clusteringSummary)
+
+        with open(self._getExtraPath(self.IMPORTED_CHECKSUMS), 'a') as f:
+            for name, checksum, _, _ in newArchives:
+                f.write(f'{checksum}\t{name}\n')
+
+    def _getServerArchives(self, serverfile):
+        if os.path.isdir(serverfile):
+            return sorted(glob.glob(os.path.join(serverfile, '*.zip')))
+        if os.path.exists(serverfile):
+            return [serverfile]
+        return sorted(glob.glob(serverfile))
+
+    def _readImportedChecksums(self):
+        """ Archives imported by the Chai-1 runs of the project, as a dict
+        checksum -> (run folder, output name). Each run records its own
+        archives in extra/IMPORTED_CHECKSUMS, so the records of a deleted run
+        go away with it. The run folders are scanned because, while a
+        protocol runs, its project only holds that protocol. """
+        runsDir = os.path.dirname(self.getWorkingDir())
+        imported = {}
+        for checksumsFile in sorted(glob.glob(os.path.join(
+                runsDir, '*', 'extra', self.IMPORTED_CHECKSUMS))):
+            run = os.path.basename(os.path.dirname(os.path.dirname(checksumsFile)))
+            with open(checksumsFile) as f:
+                for line in f:
+                    checksum, name = line.rstrip('\n').split('\t')
+                    imported.setdefault(checksum, (run, name))
+        return imported
 
     def _downloadFastaFile(self):
         pdb_id = self.PDBid.get()
         print(pdb_id)
-        url = f'https://www.rcsb.org/fasta/entry/{pdb_id}'
         fasta_filename = f'{pdb_id}.fasta'
         output_path = os.path.join(self._getTmpPath(), fasta_filename)
-        response = requests.get(url)
-        if response.status_code == 200:
-            with open(output_path, 'w') as f:
-                f.write(response.text)
-            self._reformatFastaFile(output_path)
-            self.info(f"FASTA file downloaded and reformatted to: {output_path}")
-            return output_path
-        else:
-            raise Exception(f"No se pudo descargar el archivo FASTA para {pdb_id}. "
-                             f"Código de estado: {response.status_code}")
+        with self._profilePhase('fastaFetch'):
+            Plugin.getFastaFetcher().fetch(pdb_id, output_path)
+        self.info(f"FASTA file downloaded and reformatted to: {output_path}")
+        return output_path
 
     def _reformatFastaFile(self, file_path):
-        reformatted_lines = []
-        with open(file_path, 'r') as f:
-            lines = f.readlines()
-            for line in lines:
-                if line.startswith('>'):
-                    # Extract the protein name
-                    parts = line.split('|')
-                    if len(parts) > 2:
-                        protein_name = parts[2].strip()
-                    else:
-                        protein_name = "Unknown protein"
-                    reformatted_lines.append(f">protein|{protein_name}\n")
-                else:
-                    reformatted_lines.append(line)
-
-        # Overwrite the file with reformatted content
-        with open(file_path, 'w') as f:
-            f.writelines(reformatted_lines)
+        reformatFastaFile(file_path)
 
     def _predictStructure(self):
-        pdb_id = self.PDBid.get()
-        fasta_path = os.path.abspath(os.path.join(self._getTmpPath(), f"{pdb_id}.fasta"))
+        """ Fold the input with chai-lab, or copy it from the prediction
+        cache. The models are post-processed by the following steps. """
+        fasta_path = self._getFastaPath()
         output_dir = os.path.abspath(self._getExtraPath())  # Directorio absoluto para guardar el resultado
         os.makedirs(output_dir, exist_ok=True)
+        if self._isStepDone('fold'):
+            self.info("chai-lab ya había terminado en una ejecución anterior.")
+            return
 
         # Verificar si el archivo FASTA existe
         if not os.path.exists(fasta_path):
             raise Exception(f"No se encontró el archivo FASTA en {fasta_path}")
 
+        msaInfo = self._getMsaInfo()
+        if msaInfo['hashes']:
+            self.info(f"{len(msaInfo['hashes'])} chains folded with MSAs"
+                      + (" from the ColabFold server" if msaInfo['server']
+                         else " from the MSA store"))
+
+        if self.useCache.get():
+            cacheKey = self._getCacheKey()
+            if Plugin.getPredictionCache().get(cacheKey, output_dir):
+                self.info(f"Prediction found in the cache ({cacheKey}), "
+                          f"chai-lab is not run.")
+                # The cache holds the models as written by chai-lab, they
+                # are post-processed by the following steps
+                self._markStepDone('fold')
+                return
+
+        # chai-lab requires an empty output directory, while extra already
+        # holds the step markers and the profile: fold in tmp and move the
+        # results. A previous interrupted fold is discarded.
+        fold_dir = os.path.abspath(self._getTmpPath('fold'))
+        if os.path.exists(fold_dir):
+            shutil.rmtree(fold_dir)
+        os.makedirs(fold_dir)
+
         # Ejecutar el comando de predicción
-        predict_args = ["fold", fasta_path, output_dir]
-        self.info(f"Ejecutando chai-lab con los siguientes argumentos: {predict_args}")
-        Plugin.runChai(self, "chai-lab", predict_args, cwd=output_dir)
+        self.info(f"Ejecutando chai-lab con los siguientes argumentos: {fasta_path} {fold_dir}")
+        self._runFold(fasta_path, fold_dir)
+        for fn in os.listdir(fold_dir):
+            dst = os.path.join(output_dir, fn)
+            if os.path.isdir(dst):
+                shutil.rmtree(dst)
+            os.replace(os.path.join(fold_dir, fn), dst)
+
+        if msaInfo['server']:
+            added = Plugin.getMsaStore().put(self._getExtraPath(self.MSA_DIR))
+            self.info(f"{added} new MSAs added to the MSA store.")
 
         # Verificar los archivos generados en el directorio de salida
         generated_files = os.listdir(output_dir)
         self.info(f"Archivos generados en {output_dir}: {generated_files}")
 
-        # Buscar archivos .cif generados en el directorio
-        cif_files = [file for file in generated_files if file.endswith(".cif")]
+        if not self._getModelFiles(output_dir):
+            raise Exception(f"No se encontró el archivo de estructura predicha en {output_dir}")
 
-        if cif_files:
+        if self.useCache.get():
+            # Before post-processing, so a cache hit is post-processed with
+            # the options of the run that reads it
+            Plugin.getPredictionCache().put(self._getCacheKey(),
+                                            collectOutputs(output_dir))
+        self._markStepDone('fold')
+
+    def _postProcessModelStep(self, i):
+        """ Write the confidence sidecar of model i and the model in the
+        output format, with the per-residue pLDDT if rewriteModels is set. """
+        cifFile = self._getExtraPath(self.MODEL_PATTERN % i)
+        if self._isStepDone(f'model_{i}') or not os.path.exists(cifFile):
+            return
+        outFile = self._getOutputFile(cifFile)
+        job = (cifFile, outFile, lddtSidecarPath(outFile))
+        _, usage = self._runInPool(runMeasured,
+                                   partial(writeLddtCif,
+                                           rewrite=self.rewriteModels.get()),
+                                   *job)
+        if outFile != cifFile:
+            os.remove(cifFile)
+        self._addPhase(f'postProcess_model_{i}', usage)
+        print(f'Archivo {job[2]} guardado correctamente.')
+        self._markStepDone(f'model_{i}')
+
+    def _registerOutputStep(self):
+        self._shutdownPool()
+        with self._profilePhase('registration'):
+            atomStructPaths = self._getModelFiles(os.path.abspath(self._getExtraPath()))
             # Llamar a createOutputStep con los archivos .cif
-            atomStructPaths = [os.path.join(output_dir, file) for file in cif_files]
-            print(atomStructPaths)
-            self.createOutputStep(atomStructPaths)
-            self.info(f"Estructuras predichas guardadas: {atomStructPaths}")
-        else:
-            raise Exception(f"No se encontró el archivo de estructura predicha en {output_dir}")
-        for i, cif_file in enumerate(atomStructPaths, start=1):
-            amino_acids, average_lddt_values = self.process_cif_file(cif_file)
-            with open(cif_file, 'r') as f:
-                lines = f.readlines()
-
-            # Modificar las líneas que comienzan con 'ATOM'
-            atom_index = 0
-            new_lines = []
-            for line in lines:
-                if line.startswith('ATOM '):
-                    parts = line.split()
-                    number = int(parts[7])
-                    if number == atom_index + 1:
-                        atom_index = atom_index
-                    else:
-                        atom_index = atom_index + 1
-                    parts[
-                        14] = f"{average_lddt_values[atom_index]:.10f}"  # Cambiar el valor 1.00 por average_lddt_values
-                    new_line = ' '.join(parts) + '\n'
-                    new_lines.append(new_line)
-                else:
-                    new_lines.append(line)
-
-            # Escribir el contenido modificado de nuevo en el archivo
-            with open(cif_file, 'w') as f:
-                f.writelines(new_lines)
-
-            with open(cif_file, 'a') as f:
-                f.write("\n# LDDT values\n")
-                f.write("loop_\n")
-                f.write("_scipion_attributes.name\n")
-                f.write("_scipion_attributes.recipient\n")
-                f.write("scipion_attributes.specifier\n")
-                f.write("scipion_attributes.value\n")
-                cont = 1
-                for index, (amino_acid, lddt_value) in enumerate(zip(amino_acids, average_lddt_values),
-                                                                 start=1):
-                    f.write(f'LDDT residues: {cont} {amino_acid} {lddt_value}\n')
-                    cont = cont + 1
-
-        lddt_files = []
-        for i, cif_files in enumerate(atomStructPaths, start=1):
-            amino_acids, average_lddt_values = self.process_cif_file(cif_files)
-            file_name = self._getPath(f'extra/lddt_{i - 1}.txt')
-            cont = 1
-            with open(file_name, 'w') as f:
-                for amino_acid, lddt_value in zip(amino_acids, average_lddt_values):
-                    f.write(f'LDDT  {amino_acid}  {lddt_value:.8f}\n')
-                    cont = cont + 1
-                print(f'Archivo {file_name} guardado correctamente.')
-
-            lddt_files.append(file_name)
-
-    def process_cif_file(self, cif_files):
-        amino_acid_values = defaultdict(list) # Diccionario para agrupar valores por aminoácido
-        amino_acid_names=defaultdict(list)
-        cont=1
-        with open(cif_files, 'r') as cif_file:
-            for line in cif_file:
-                if line.startswith("ATOM"):
-                    parts = line.split()
-                    amino_acid = parts[6]  # Nombre del aminoácido
-                    number_aa = int(parts[7])
-                    value = float(parts[18])
-                    if number_aa == cont:
-                        amino_acid_values[cont].append(value)
-                        amino_acid_names[cont].append(amino_acid)
-                    else:
-                        cont=cont+1
-                        amino_acid_values[cont].append(value)
-                        amino_acid_names[cont].append(amino_acid)
-        # Calcular el promedio por aminoácido
-        amino_acids = []
-        average_values = []
-        for number_aa in sorted(amino_acid_values.keys()):  # Ordenar por número de aminoácido
-            values = amino_acid_values[number_aa]
-            names = amino_acid_names[number_aa]
-
-            avg_value = sum(values) / len(values) if values else 0  # Calcular el promedio de los valores pLDDT
-            amino_acids.append(f"{names[0]}")  # Nombre del primer aminoácido
-            average_values.append(avg_value)  # Agregar el promedio calculado
-
-        return amino_acids, average_values
-
-
-    def createOutputStep(self, atomStructPaths, paeFns=[]):
-            """ Copy the atomic structure and register the output object.
-            :param list_string atomStructPath: list of atom struct files to be
-                                                saved
-            """
-            # Preparar el diccionario de salida
-            kwargs = {}
-
-            for atomStructPath in atomStructPaths:
-                # Verifica si el archivo existe
-                if not os.path.exists(atomStructPath):
-                    raise Exception(f"Atomic structure not found at *{atomStructPath}*")
-
-                # Procesa los archivos .pdb o .cif
-                if atomStructPath.endswith(".pdb") or atomStructPath.endswith(".cif"):
-                    # Crear el objeto de estructura atómica
-                    pdb = emobj.AtomStruct()
-                    pdb.setFileName(atomStructPath)
-                    atomStructPath = os.path.basename(atomStructPath)
-
-                    # Si es un archivo .cif, procesa el nombre correctamente
-                    if atomStructPath.endswith(".cif"):
-                        keyword = atomStructPath.split(".cif")[0].replace(".", "_")
-                    else:
-                        keyword = atomStructPath.split(".pdb")[0].replace(".", "_")
-
-                    # Verifica si la palabra clave comienza con un número, y agrega un prefijo si es necesario
-                    if keyword[0].isdigit():
-                        keyword = "AS_" + keyword
-                    kwargs[keyword] = pdb
-
-            # Si se tiene algún archivo .json de PAE, también se registra
-            for paeFn in paeFns:
-                paeObject = PAE(filename=paeFn)
-                paeFn = os.path.basename(paeFn)
-                if paeFn.endswith(".json"):
-                    keyword = paeFn.split(".json")[0].replace(".", "_")
-                else:
-                    keyword = paeFn.split(".jsn")[0].replace(".", "_")
-                if keyword[0].isdigit():
-                    keyword = "PAE_" + keyword
-                kwargs[keyword] = paeObject
-
-            # Definir los objetos de salida
-            self._defineOutputs(**kwargs)
+            self.foldOptions.set(json.dumps(getFoldOptions(self)))
+            self._store(self.foldOptions)
+            scores = readScores([scoresPath(fn) for fn in atomStructPaths])
+            ranking = rankModels(scores)
+            if self.topModels.get() > 0:
+                ranking = ranking[:self.topModels.get()]
+            self._summarizeScores(atomStructPaths, scores, ranking)
+            rankedPaths = [atomStructPaths[i] for i in ranking]
+            self.createOutputStep(rankedPaths, scores=(scores, ranking))
+            self.info(f"Estructuras predichas guardadas: {rankedPaths}")
+        self._storeProfile()
+
+    def _summarizeScores(self, atomStructPaths, scores, ranking):
+        lines = []
+        for rank, i in enumerate(ranking):
+            name = os.path.basename(atomStructPaths[i])
+            if np.isnan(scores[SCORE_AGGREGATE][i]):
+                lines.append(f'| {name} has no scores')
+                continue
+            line = (f'| {name} (rank {rank}) has an aggregate score of '
+                    f'{scores[SCORE_AGGREGATE][i]:.3f}, pTM '
+                    f'{scores[SCORE_PTM][i]:.3f}, ipTM {scores[SCORE_IPTM][i]:.3f}')
+            if scores[SCORE_CLASHES][i]:
+                line += ' and inter-chain clashes'
+            lines.append(line)
+        self.clusteringSummary.set(' '.join(lines))
+        self._store(self.clusteringSummary)
+
+    def _runFold(self, fastaPath, outputDir):
+        """ Run chai-lab and profile the environment activation and the
+        inference separately. The CPU time of the chai-lab subprocess,
+        activation included, is counted in the inference phase, and so is
+        its peak RSS. """
+        stamp = os.path.abspath(self._getTmpPath('activated'))
+        if os.path.exists(stamp):
+            os.remove(stamp)
+        start = time.time()
+        with measurePhase() as usage:
+            ranSubprocess = Plugin.runFold(
+                self, fastaPath, outputDir, activationStamp=stamp,
+                useEmbeddingCache=self.useEmbeddingCache.get(),
+                **getFoldOptions(self), **self._getMsaOptions())
+        if ranSubprocess:
+            setSubprocessRss(usage)
+        if os.path.exists(stamp):
+            # Not written when the persistent worker served the request
+            activation = os.path.getmtime(stamp) - start
+            self._addPhase('activation', {'wall': activation, 'cpu': 0.0,
+                                          'peakRss': usage['peakRss'],
+                                          'rssOf': usage['rssOf']})
+            usage['wall'] -= activation
+        self._addPhase('inference', usage)
+
+    @contextmanager
+    def _profilePhase(self, phase):
+        with measurePhase() as usage:
+            yield usage
+        self._addPhase(phase, usage)
+
+    def _addPhase(self, phase, usage):
+        """ Record the usage of phase in extra/profile.json, which is shared
+        by the steps running in parallel. """
+        with self._profileLock:
+            addPhase(self._getExtraPath(PROFILE_FILE), phase, usage)
+
+    def _storeProfile(self):
+        self.profile.set(json.dumps(readProfile(self._getExtraPath(PROFILE_FILE))))
+        self._store(self.profile)
+
+    def _getCacheKey(self):
+        options = getFoldOptions(self)
+        msaHashes = self._getMsaInfo()['hashes']
+        if msaHashes:
+            options['msas'] = msaHashes
+        return predictionKey(self._getFastaPath(), CHAI1_DEFAULT_VERSION,
+                             options)
+
+    def _getMsaInfo(self):
+        """ MSAs used to fold the input: {'server': bool, 'hashes': [...]}
+        with the sequence hashes of the protein chains that have an MSA.
+
+        Stored MSAs are linked into extra/msas. When some chain is missing
+        and the ColabFold server is enabled, chai-lab computes all of them
+        instead. The decision is saved in extra/msas.json, so the cache key
+        does not change when the new MSAs are added to the store.
+        """
+        infoFile = self._getExtraPath(self.MSA_INFO)
+        if os.path.exists(infoFile):
+            with open(infoFile) as f:
+                return json.load(f)
+
+        proteins = [seq for entity, seq in readFastaRecords(self._getFastaPath())
+                    if entity == 'protein']
+        info = {'server': False, 'hashes': []}
+        if proteins and (self.useMsaStore.get() or self.useMsaServer.get()):
+            store = Plugin.getMsaStore()
+            complete = (self.useMsaStore.get() and
+                        all(store.contains(seq) for seq in proteins))
+            if self.useMsaServer.get() and not complete:
+                info = {'server': True,
+                        'hashes': sorted({sequenceHash(seq) for seq in proteins})}
+            elif self.useMsaStore.get():
+                info['hashes'] = store.get(proteins,
+                                           self._getExtraPath(self.MSA_DIR))
+        with open(infoFile, 'w') as f:
+            json.dump(info, f)
+        return info
+
+    def _getMsaOptions(self):
+        """ chai-lab options that give it the MSAs of _getMsaInfo. """
+        info = self._getMsaInfo()
+        if info['server']:
+            return {'use_msa_server': True}
+        if info['hashes']:
+            return {'msa_directory': os.path.abspath(self._getExtraPath(self.MSA_DIR))}
+        return {}
+
+    def _getStepMarker(self, name):
+        return self._getExtraPath('steps', name + '.done')
+
+    def _isStepDone(self, name):
+        return os.path.exists(self._getStepMarker(name))
+
+    def _markStepDone(self, name):
+        marker = self._getStepMarker(name)
+        os.makedirs(os.path.dirname(marker), exist_ok=True)
+        open(marker, 'w').close()
+
+    def _runInPool(self, func, *args):
+        """ Run func in the process pool shared by the parallel steps, so
+        the CPU-bound post-processing is not serialized by the GIL. """
+        if self.numberOfThreads.get() <= 1:
+            return func(*args)
+        with self._poolLock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.numberOfThreads.get())
+        return self._pool.submit(func, *args).result()
+
+    def _shutdownPool(self):
+        with self._poolLock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def _getFastaPath(self):
+        if self.source.get() == self.IMPORT_FASTA:
+            return os.path.abspath(self.FASTA.get())
+        return os.path.abspath(os.path.join(self._getTmpPath(),
+                                            f"{self.PDBid.get()}.fasta"))
+
+    def _getModelFiles(self, output_dir):
+        # Buscar archivos .cif (o .cif.gz) generados en el directorio
+        return sorted((os.path.join(output_dir, file)
+                       for file in os.listdir(output_dir)
+                       if file.endswith((".cif", ".cif" + GZIP_SUFFIX))),
+                      key=modelIndex)
+
+    def _isCompressed(self):
+        return self.outputFormat.get() == self.FORMAT_CIF_GZ
+
+    def _getOutputFile(self, cifFile):
+        """ Path of a rewritten model in the output format. """
+        return cifFile + GZIP_SUFFIX if self._isCompressed() else cifFile
+
+    def _modelJobs(self, cifFiles, outFiles=None):
+        """ Post-processing jobs of a prediction: (cifFile, outFile, lddtFile)
+        with the confidence sidecar next to each rewritten model.
+
+        :param cifFiles: model files, or (zip file, member) pairs.
+        :param outFiles: rewritten models, by default cifFiles are rewritten
+                         in place.
+        """
+        outFiles = outFiles or cifFiles
+        return [(cifFile, outFile, lddtSidecarPath(outFile))
+                for cifFile, outFile in zip(cifFiles, outFiles)]
+
+    def _postProcessModels(self, jobs):
+        """ Write the confidence sidecar of every model, and the model with
+        the per-residue pLDDT if rewriteModels is set, using up to
+        numberOfThreads worker processes. """
+        writeLddtCifs(jobs, numberOfWorkers=self.numberOfThreads.get(),
+                      rewrite=self.rewriteModels.get())
+        for _, _, lddtFile in jobs:
+            print(f'Archivo {lddtFile} guardado correctamente.')
+
+    def createOutputStep(self, atomStructPaths, scores=None):
+        """ Register the predicted models as a single set of atomic
+        structures, with the model metadata as columns of every item.
+
+        :param atomStructPaths: model files, in output order.
+        :param scores: optional (scores, ranking) of the models, see
+                       convert.readScores and convert.rankModels, with
+                       atomStructPaths sorted as ranking.
+        """
+        foldOptions = json.loads(self.foldOptions.get() or '{}')
+        atomStructs = self._createSetOfPDBs()
+        for rank, atomStructPath in enumerate(atomStructPaths):
+            if not os.path.exists(atomStructPath):
+                raise Exception(f"Atomic structure not found at *{atomStructPath}*")
+            atomStruct = emobj.AtomStruct(filename=atomStructPath)
+            setModelAttributes(atomStruct, atomStructPath)
+            setFoldAttributes(atomStruct, foldOptions)
+            if scores is not None:
+                setScoreAttributes(atomStruct, scores[0], scores[1][rank], rank)
+            atomStructs.append(atomStruct)
+        atomStructs.write()  # all the items in a single transaction
+
+        name = 'output_' + targetName(self._getFastaPath())
+        self._defineOutputs(**{name: atomStructs})
 
     # --------------------------- INFO functions -----------------------------------
     def _validate(self):
@@ -416,18 +739,28 @@ class Chai1Protocol(EMProtocol):
     def _summary(self):
         """ Summarize what the protocol has done"""
         summary = []
-
-        if self.isFinished():
-            summary.append(f"This protocol has printed *{self.message}* {self.times} times.")
+        if self.clusteringSummary.get():
+            summary.append(self.clusteringSummary.get())
+        if self.foldOptions.get():
+            options = json.loads(self.foldOptions.get())
+            summary.append(f"Fold preset {FOLD_PRESET_NAMES[self.preset.get()]}: "
+                           + ", ".join(f"{key} = {value}"
+                                       for key, value in options.items()))
+        if self.profile.get():
+            summary.append("Time and memory per phase:")
+            summary.extend(formatProfile(json.loads(self.profile.get())))
+            summary.append(f"Profile exported to {self._getExtraPath(PROFILE_FILE)}")
         return summary
 
     def _methods(self):
         methods = []
 
         if self.isFinished():
-            methods.append(f"{self.message} has been printed in this run {self.times} times.")
-            if self.previousCount.hasPointer():
-                methods.append("Accumulated count from previous runs were %i."
-                               " In total, %s messages has been printed."
-                               % (self.previousCount, self.count))
+            if self.runserver.get() == self.RUN_SERVER:
+                methods.append(f"Structures predicted by the Chai-1 server "
+                               f"were imported from {self.serverfile.get()}.")
+            else:
+                methods.append(f"Structures were predicted with Chai-1 "
+                               f"(chai-lab {CHAI1_DEFAULT_VERSION}) from "
+                               f"{os.path.basename(self._getFastaPath())}.")
         return methods
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+
+"""
+Batch version of the Chai-1 protocol: fold a whole campaign of targets
+(PDB IDs, FASTA files or sequences) with a single chai-lab process.
+"""
+import glob
+import json
+import os
+import shutil
+
+import pwem.objects as emobj
+import pyworkflow.utils as pwutils
+from pwem.protocols import EMProtocol
+from pyworkflow.object import String
+from pyworkflow.protocol.params import (EnumParam, FileParam, PathParam,
+                                        PointerParam, BooleanParam,
+                                        LEVEL_ADVANCED)
+
+from .. import Plugin
+from .protocol_chai1 import (addFoldParams, addPostProcessParams,
+                             getFoldOptions, setFoldAttributes,
+                             setModelAttributes)
+from ..cache import predictionKey, collectOutputs
+from ..constants import CHAI1_DEFAULT_VERSION
+from ..convert import writeLddtCifs, lddtSidecarPath
+from ..utils import writeSequenceFasta, targetName, foldArgs, modelIndex
+from ..worker import connect, submitFold
+
+
+class Chai1BatchProtocol(EMProtocol):
+    """Protocol to run Chai-1 on many targets in a single job queue."""
+
+    SOURCE_PDBIDS = 0
+    SOURCE_FASTADIR = 1
+    SOURCE_SEQUENCES = 2
+
+    JOBS_FILE = 'jobs.txt'
+
+    _label = 'Chai-1 batch'
+
+    def __init__(self, **args):
+        EMProtocol.__init__(self, **args)
+        self.failedTargets = String()  # JSON list of targets without models
+
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('source', EnumParam,
+                      label='Targets',
+                      choices=['File with PDB IDs',
+                               'Folder with FASTA files',
+                               'Set of sequences'],
+                      default=self.SOURCE_PDBIDS)
+        form.addParam('pdbIdsFile', FileParam,
+                      condition='source==%d' % self.SOURCE_PDBIDS,
+                      label='PDB IDs file',
+                      help='Text file with one PDB ID per line (blank lines '
+                           'and lines starting with # are ignored).')
+        form.addParam('fastaDir', PathParam,
+                      condition='source==%d' % self.SOURCE_FASTADIR,
+                      label='FASTA folder',
+                      help='Folder with one chai-lab FASTA file (*.fasta, '
+                           '*.fa) per target.')
+        form.addParam('inputSequences', PointerParam,
+                      pointerClass='SetOfSequences',
+                      condition='source==%d' % self.SOURCE_SEQUENCES,
+                      label='Input sequences',
+                      help='Every sequence is folded as a separate target.')
+        form.addParam('useCache', BooleanParam, default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Reuse cached predictions',
+                      help='Targets already in the prediction cache '
+                           '(CHAI1_CACHE_DIR) are copied from it instead of '
+                           'being folded again.')
+        form.addParam('useEmbeddingCache', BooleanParam, default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Reuse cached ESM embeddings',
+                      help='Chains shared by several targets, or folded in '
+                           'previous runs, are embedded only once. See '
+                           'CHAI1_CACHE_DIR and CHAI1_EMBEDDING_CACHE_SIZE.')
+        addPostProcessParams(form)
+
+        addFoldParams(form)
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ---------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.prepareTargetsStep)
+        self._insertFunctionStep(self.foldStep)
+        self._insertFunctionStep(self.postProcessStep)
+        self._insertFunctionStep(self.createOutputStep)
+
+    # --------------------------- STEPS functions ----------------------------
+    def prepareTargetsStep(self):
+        """ Write one FASTA file per target and the jobs file read by the
+        batch fold script. """
+        fastaDir = self._getTmpPath('targets')
+        os.makedirs(fastaDir, exist_ok=True)
+        jobs = []
+        downloads = []
+        names = set()
+        for name, writeFasta in self._iterTargets():
+            if name in names:
+                name = f'{name}_{len(jobs)}'
+            names.add(name)
+            fastaFile = os.path.abspath(os.path.join(fastaDir, name + '.fasta'))
+            if isinstance(writeFasta, str):  # PDB ID, fetched below
+                downloads.append((writeFasta, fastaFile))
+            else:
+                writeFasta(fastaFile)
+            jobs.append((fastaFile, self._getTargetPath(name)))
+
+        if not jobs:
+            raise Exception("No targets found in the input.")
+        if downloads:
+            self.info(f"Fetching {len(downloads)} FASTA files from RCSB")
+            Plugin.getFastaFetcher().fetchMany(downloads)
+
+        with open(self._getJobsFile(), 'w') as f:
+            for fastaFile, outputDir in jobs:
+                f.write(f'{fastaFile}\t{outputDir}\n')
+        self.info(f"{len(jobs)} targets prepared in {self._getJobsFile()}")
+
+    def foldStep(self):
+        if self.useCache.get():
+            self._restoreCachedTargets()
+
+        conn = connect(Plugin.getWorkerAddress())
+        if conn is None:
+            Plugin.runChaiScript(self, 'chai1_batch_fold.py',
+                                 ['--jobs', self._getJobsFile()]
+                                 + foldArgs(getFoldOptions(self))
+                                 + (Plugin.getEmbeddingCacheArgs()
+                                    if self.useEmbeddingCache.get() else []),
+                                 cwd=self._getExtraPath())
+        else:
+            # A persistent worker is running, send it the targets one by one
+            options = getFoldOptions(self)
+            if self.useEmbeddingCache.get():
+                options['embedding_cache'] = Plugin.getEmbeddingCache()
+            with conn:
+                for fastaFile, outputDir in self._readJobs():
+                    if self._getTargetModels(os.path.basename(outputDir)):
+                        continue
+                    if os.path.isdir(outputDir):
+                        # Partial output of a failed attempt, chai-lab
+                        # requires an empty output directory
+                        shutil.rmtree(outputDir)
+                    self.info(f"Sending {fastaFile} to the chai-lab worker")
+                    try:
+                        submitFold(conn, fastaFile, outputDir, **options)
+                    except (EOFError, OSError):
+                        raise  # the worker is gone
+                    except Exception as e:
+                        self.warning(f"{e}, continuing with the next target")
+
+        failed = [name for name in self._getTargetNames()
+                  if not self._getTargetModels(name)]
+        if failed:
+            self.warning(f"{len(failed)} targets failed: {', '.join(failed)}")
+        self.failedTargets.set(json.dumps(failed))
+        self._store(self.failedTargets)
+
+        if self.useCache.get():
+            self._cacheTargets()
+
+    def postProcessStep(self):
+        jobs = []
+        for name in self._getTargetNames():
+            for cifFile in self._getTargetModels(name):
+                jobs.append((cifFile, cifFile, lddtSidecarPath(cifFile)))
+        writeLddtCifs(jobs, numberOfWorkers=self.numberOfThreads.get(),
+                      rewrite=self.rewriteModels.get())
+
+    def createOutputStep(self):
+        options = getFoldOptions(self)
+        outputs = {}
+        for name in self._getTargetNames():
+            models = self._getTargetModels(name)
+            if not models:
+                self.warning(f"No predicted models found for {name}")
+                continue
+            atomStructs = self._createSetOfPDBs(suffix='_' + name)
+            for cifFile in models:
+                atomStruct = emobj.AtomStruct(filename=cifFile)
+                setModelAttributes(atomStruct, cifFile)
+                setFoldAttributes(atomStruct, options)
+                atomStructs.append(atomStruct)
+            atomStructs.write()
+            outputs['output_' + name] = atomStructs
+
+        if not outputs:
+            raise Exception("Chai-1 did not produce any model.")
+        self._defineOutputs(**outputs)
+
+    # --------------------------- INFO functions -----------------------------
+    def _validate(self):
+        errors = []
+        if self.source.get() == self.SOURCE_PDBIDS and not self.pdbIdsFile.get():
+            errors.append("A file with PDB IDs is required.")
+        elif self.source.get() == self.SOURCE_FASTADIR and not self.fastaDir.get():
+            errors.append("A folder with FASTA files is required.")
+        return errors
+
+    def _summary(self):
+        summary = []
+        failed = json.loads(self.failedTargets.get() or '[]')
+        if self.isFinished():
+            summary.append(f"{len(self._getTargetNames()) - len(failed)} "
+                           f"targets folded.")
+        if failed:
+            summary.append(f"{len(failed)} targets failed and have no "
+                           f"models: {', '.join(failed)}")
+        return summary
+
+    # --------------------------- UTILS functions ----------------------------
+    def _iterTargets(self):
+        """ Yield (name, writeFasta) for every target of the campaign.
+        writeFasta is the PDB ID for the targets downloaded from RCSB. """
+        if self.source.get() == self.SOURCE_PDBIDS:
+            with open(self.pdbIdsFile.get()) as f:
+                for line in f:
+                    pdbId = line.strip()
+                    if pdbId and not pdbId.startswith('#'):
+                        yield targetName(pdbId), pdbId
+        elif self.source.get() == self.SOURCE_FASTADIR:
+            fastaDir = self.fastaDir.get()
+            for fastaFile in sorted(glob.glob(os.path.join(fastaDir, '*.fasta')) +
+                                    glob.glob(os.path.join(fastaDir, '*.fa'))):
+                yield (targetName(fastaFile),
+                       lambda fn, src=fastaFile: pwutils.copyFile(src, fn))
+        else:
+            for sequence in self.inputSequences.get().iterItems():
+                seq = sequence.clone()
+                name = seq.getSeqName() or seq.getId() or 'seq%d' % seq.getObjId()
+                yield (targetName(name),
+                       lambda fn, seq=seq: writeSequenceFasta(seq, fn))
+
+    def _getJobsFile(self):
+        return os.path.abspath(self._getExtraPath(self.JOBS_FILE))
+
+    def _getTargetPath(self, name):
+        return os.path.abspath(self._getExtraPath(name))
+
+    def _restoreCachedTargets(self):
+        """ Copy the targets found in the prediction cache into their output
+        folders, so they are not folded again. """
+        cache = Plugin.getPredictionCache()
+        for fastaFile, outputDir in self._readJobs():
+            if self._getTargetModels(os.path.basename(outputDir)):
+                continue
+            key = predictionKey(fastaFile, CHAI1_DEFAULT_VERSION,
+                                getFoldOptions(self))
+            if cache.get(key, outputDir):
+                self.info(f"{fastaFile} found in the prediction cache ({key})")
+
+    def _cacheTargets(self):
+        """ Store the folded targets in the prediction cache, before they are
+        post-processed. Targets restored from the cache are only marked as
+        recently used. """
+        cache = Plugin.getPredictionCache()
+        for fastaFile, outputDir in self._readJobs():
+            if not self._getTargetModels(os.path.basename(outputDir)):
+                continue  # failed target
+            outputs = collectOutputs(outputDir)
+            if outputs:
+                cache.put(predictionKey(fastaFile, CHAI1_DEFAULT_VERSION,
+                                        getFoldOptions(self)),
+                          outputs)
+
+    def _readJobs(self):
+        with open(self._getJobsFile()) as f:
+            return [line.rstrip('\n').split('\t') for line in f if line.strip()]
+
+    def _getTargetNames(self):
+        return [os.path.basename(outputDir) for _, outputDir in self._readJobs()]
+
+    def _getTargetModels(self, name):
+        targetPath = self._getTargetPath(name)
+        return sorted(glob.glob(os.path.join(targetPath, '*.cif')) +
+                      glob.glob(os.path.join(targetPath, '*.cif.gz')),
+                      key=modelIndex)
+
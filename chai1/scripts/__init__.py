@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# Scripts executed with the python interpreter of the chai-lab environment
+# **************************************************************************
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Fold several FASTA files with chai-lab in a single process.
+
+This script runs inside the chai-lab environment, so the environment
+activation and the torch/chai-lab imports are paid once per campaign
+instead of once per target. The jobs file has one target per line:
+
+    <fasta file> <TAB> <output directory>
+
+Targets whose output directory already contains predicted models are
+skipped, so the script can be relaunched to resume an interrupted campaign.
+A target that fails is logged and the campaign goes on with the next one;
+its partial output is removed before it is folded again.
+"""
+import argparse
+import os
+import shutil
+import sys
+import traceback
+from pathlib import Path
+
+from embedding_cache import addArguments, installFromArgs
+from fold_outputs import saveErrorMatrices
+
+FOLD_OPTIONS = ['num_trunk_recycles', 'num_diffn_timesteps',
+                'num_diffn_samples', 'seed']
+
+
+def readJobs(jobsFile):
+    with open(jobsFile) as f:
+        return [line.rstrip('\n').split('\t') for line in f if line.strip()]
+
+
+def isFolded(outputDir):
+    return (os.path.isdir(outputDir) and
+            any(fn.endswith(('.cif', '.cif.gz')) for fn in os.listdir(outputDir)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', required=True,
+                        help='Text file with one "fasta<TAB>outputDir" per line')
+    parser.add_argument('--device', default=None)
+    addArguments(parser)
+    # Same options as chai-lab fold, chai-lab defaults are used if missing
+    for option in FOLD_OPTIONS:
+        parser.add_argument('--' + option.replace('_', '-'), type=int,
+                            dest=option)
+    args = parser.parse_args()
+    options = {option: getattr(args, option) for option in FOLD_OPTIONS
+               if getattr(args, option) is not None}
+
+    installFromArgs(args)
+    from chai_lab.chai1 import run_inference
+
+    jobs = readJobs(args.jobs)
+    failed = []
+    for i, (fastaFile, outputDir) in enumerate(jobs, start=1):
+        if isFolded(outputDir):
+            print(f"[{i}/{len(jobs)}] {fastaFile} already folded, skipping")
+            continue
+        if os.path.isdir(outputDir):
+            # Partial output of a failed attempt, chai-lab requires an
+            # empty output directory
+            shutil.rmtree(outputDir)
+        print(f"[{i}/{len(jobs)}] Folding {fastaFile} into {outputDir}")
+        sys.stdout.flush()
+        try:
+            candidates = run_inference(fasta_file=Path(fastaFile),
+                                       output_dir=Path(outputDir),
+                                       device=args.device, **options)
+            saveErrorMatrices(candidates, outputDir)
+        except Exception:
+            traceback.print_exc()
+            print(f"[{i}/{len(jobs)}] {fastaFile} failed, continuing with "
+                  f"the next target")
+            failed.append(fastaFile)
+        sys.stdout.flush()
+
+    if failed:
+        print(f"{len(failed)} of {len(jobs)} targets failed: "
+              + ", ".join(failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Fold a FASTA file with chai-lab run_inference, like chai-lab fold. The ESM
+embedding cache of embedding_cache.py is used when given, and the PAE and
+PDE matrices are saved, see fold_outputs.py.
+
+    python chai1_fold.py <fasta> <output dir> [chai-lab fold options]
+        --embedding-cache <dir> --embedding-cache-size <bytes>
+"""
+import argparse
+from pathlib import Path
+
+from embedding_cache import addArguments, installFromArgs
+from fold_outputs import saveErrorMatrices
+
+INT_OPTIONS = ['num_trunk_recycles', 'num_diffn_timesteps',
+               'num_diffn_samples', 'seed']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('fasta')
+    parser.add_argument('output_dir')
+    parser.add_argument('--device', default=None)
+    for option in INT_OPTIONS:
+        parser.add_argument('--' + option.replace('_', '-'), type=int,
+                            dest=option)
+    parser.add_argument('--msa-directory', default=None)
+    parser.add_argument('--use-msa-server', action=argparse.BooleanOptionalAction,
+                        default=None)
+    addArguments(parser)
+    args = parser.parse_args()
+
+    installFromArgs(args)
+    from chai_lab.chai1 import run_inference
+
+    options = {option: getattr(args, option)
+               for option in INT_OPTIONS + ['use_msa_server']
+               if getattr(args, option) is not None}
+    if args.msa_directory:
+        options['msa_directory'] = Path(args.msa_directory)
+    candidates = run_inference(fasta_file=Path(args.fasta),
+                               output_dir=Path(args.output_dir),
+                               device=args.device, **options)
+    saveErrorMatrices(candidates, args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
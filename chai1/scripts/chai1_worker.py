@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Persistent chai-lab worker.
+
+Run it with the python of the Chai-1 environment, for instance:
+
+    conda activate chai1-0.6.1
+    python chai1_worker.py --address /tmp/chai1-worker.sock
+
+torch and chai-lab are imported once and the process stays alive, so
+successive predictions skip the environment activation, the interpreter
+start-up and the imports. The exported model components (feature embedding,
+trunk, diffusion module, confidence head...) are loaded with torch.jit.load
+by the first request and kept on the device for the next ones, so they hold
+their GPU memory while the worker runs. Folds run with chai-lab
+low_memory=False, which keeps the inputs and intermediate tensors of a fold
+on the device too. Requests are served one at a time, in arrival order,
+since they share the same GPU.
+
+Set CHAI1_WORKER_ADDRESS to the same address in the Scipion configuration
+and the Chai-1 protocols will send their folds to the worker whenever it is
+running, falling back to a chai-lab subprocess otherwise.
+"""
+import argparse
+import functools
+import os
+import sys
+import traceback
+from multiprocessing.connection import Listener
+from pathlib import Path
+
+from embedding_cache import install
+from fold_outputs import saveErrorMatrices
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+
+
+def keepComponentsLoaded():
+    """ Memoize chai_lab.chai1.load_exported by (component, device), so each
+    component is loaded once per worker instead of once per fold. chai-lab
+    looks the function up as a module global on every fold. """
+    import chai_lab.chai1 as chai1
+    if not hasattr(chai1.load_exported, 'cache_info'):
+        chai1.load_exported = functools.lru_cache(maxsize=None)(chai1.load_exported)
+
+
+def serve(listener, device=None):
+    from chai_lab.chai1 import run_inference
+    keepComponentsLoaded()
+
+    while True:
+        with listener.accept() as conn:
+            try:
+                while True:
+                    conn.send(handle(conn.recv(), run_inference, device))
+            except (EOFError, OSError):
+                pass  # the client closed the connection
+
+
+def handle(request, run_inference, device):
+    try:
+        options = dict(request.get('options') or {})
+        options.setdefault('device', device)
+        options.setdefault('low_memory', False)
+        embeddingCache = options.pop('embedding_cache', None)
+        if embeddingCache:
+            install(*embeddingCache)
+        if options.get('msa_directory'):
+            options['msa_directory'] = Path(options['msa_directory'])
+        print(f"Folding {request['fasta']} into {request['output_dir']}")
+        sys.stdout.flush()
+        candidates = run_inference(fasta_file=Path(request['fasta']),
+                                   output_dir=Path(request['output_dir']),
+                                   **options)
+        saveErrorMatrices(candidates, request['output_dir'])
+        return {'status': STATUS_OK}
+    except Exception as e:
+        traceback.print_exc()
+        return {'status': STATUS_ERROR, 'message': str(e)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--address', required=True,
+                        help='Path of the Unix socket to listen on')
+    parser.add_argument('--device', default=None)
+    args = parser.parse_args()
+
+    if os.path.exists(args.address):
+        os.remove(args.address)
+    oldMask = os.umask(0o077)  # only the owner can connect
+    try:
+        listener = Listener(args.address, family='AF_UNIX')
+    finally:
+        os.umask(oldMask)
+
+    print(f"chai-lab worker listening on {args.address}")
+    sys.stdout.flush()
+    try:
+        serve(listener, device=args.device)
+    finally:
+        listener.close()
+
+
+if __name__ == '__main__':
+    main()
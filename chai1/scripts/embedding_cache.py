@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Cache of the ESM embeddings computed by chai-lab, one file per sequence.
+
+This module runs inside the Chai-1 environment (numpy and torch come with
+chai-lab). Embeddings are stored as .npy files named by the hash of the
+sequence and of the ESM model, so they are memory-mapped when read and a
+different ESM model does not reuse them. The total size is bounded; the
+least recently used files are evicted.
+
+:func:`install` wraps the chai-lab function that embeds the protein
+sequences of a target, so that only the sequences that are not cached are
+embedded. Identical chains of a homo-oligomer and chains already seen in
+previous runs are read from the cache.
+"""
+import glob
+import hashlib
+import os
+import sys
+
+EMBEDDING_SUFFIX = '.npy'
+
+_installed = {}
+
+
+class EmbeddingCache:
+
+    def __init__(self, root, maxSize, modelVersion):
+        """
+        :param root: cache directory, created if needed.
+        :param maxSize: maximum total size in bytes.
+        :param modelVersion: identifies the embedding model, part of the key.
+        """
+        self.root = root
+        self.maxSize = maxSize
+        self.modelVersion = modelVersion
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, sequence):
+        key = hashlib.sha256(f'{self.modelVersion}:{sequence}'.encode()).hexdigest()
+        return os.path.join(self.root, key + EMBEDDING_SUFFIX)
+
+    def get(self, sequence):
+        """ Memory-mapped embedding of sequence, None if not cached. """
+        import numpy as np
+        fn = self._path(sequence)
+        try:
+            embedding = np.load(fn, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        os.utime(fn)  # mark as recently used
+        return embedding
+
+    def put(self, sequence, embedding):
+        import numpy as np
+        fn = self._path(sequence)
+        tmpFile = '%s.%d.tmp' % (fn, os.getpid())
+        with open(tmpFile, 'wb') as f:
+            np.save(f, embedding)
+        os.replace(tmpFile, fn)
+
+    def evict(self):
+        files = []
+        for fn in glob.glob(os.path.join(self.root, '*' + EMBEDDING_SUFFIX)):
+            try:
+                stat = os.stat(fn)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, fn))
+        total = sum(size for _, size, _ in files)
+        for _, size, fn in sorted(files):
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            total -= size
+
+
+def install(root, maxSize):
+    """ Serve the ESM embeddings of chai-lab from the cache in root. Calling
+    it again with the same root does nothing.
+
+    chai-lab embeds every distinct protein sequence of a target in
+    esm._get_esm_contexts_for_sequences, called through the module global
+    by get_esm_embedding_context; it is replaced by a wrapper that only
+    passes the sequences that are not cached. Cached embeddings are
+    returned as CPU tensors, like the ones computed by chai-lab.
+
+    :return: True if the cache is in use.
+    """
+    if _installed.get('root') == root:
+        return True
+    try:
+        from chai_lab.data.dataset.embeddings import esm
+    except ImportError:
+        esm = None
+    original = (_installed.get('original') or
+                getattr(esm, '_get_esm_contexts_for_sequences', None))
+    if original is None:
+        print("chai-lab _get_esm_contexts_for_sequences not found, ESM "
+              "embeddings are not cached.")
+        sys.stdout.flush()
+        return False
+
+    # The weights file identifies the ESM model, e.g.
+    # traced_sdpa_esm2_t36_3B_UR50D_fp16.pt
+    cache = EmbeddingCache(root, maxSize, os.path.basename(esm.ESM_URL))
+
+    def getEsmContexts(prot_sequences, device):
+        import numpy as np
+        import torch
+        result = {}
+        missing = set()
+        for sequence in prot_sequences:
+            embedding = cache.get(sequence)
+            if embedding is None:
+                missing.add(sequence)
+            else:
+                result[sequence] = esm.EmbeddingContext(
+                    esm_embeddings=torch.from_numpy(np.array(embedding)))
+        print(f"ESM embeddings: {len(result)} cached, {len(missing)} computed")
+        sys.stdout.flush()
+        if missing:
+            computed = original(prot_sequences=missing, device=device)
+            for sequence, context in computed.items():
+                cache.put(sequence,
+                          context.esm_embeddings.detach().cpu().numpy())
+                result[sequence] = context
+            cache.evict()
+        return result
+
+    esm._get_esm_contexts_for_sequences = getEsmContexts
+    _installed.update(root=root, original=original)
+    return True
+
+
+def addArguments(parser):
+    """ Command line options of the scripts that fold with the cache. """
+    parser.add_argument('--embedding-cache', default=None,
+                        help='Directory of the ESM embedding cache')
+    parser.add_argument('--embedding-cache-size', type=float, default=0,
+                        help='Maximum size of the cache in bytes')
+
+
+def installFromArgs(args):
+    if args.embedding_cache:
+        install(args.embedding_cache, args.embedding_cache_size)
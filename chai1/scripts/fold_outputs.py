@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Extra outputs of chai-lab run_inference written by the fold scripts.
+
+chai-lab keeps the predicted aligned error (PAE) and distance error (PDE) of
+every model in memory only. They are saved next to the models as
+pae.model_idx_<i>.npy and pde.model_idx_<i>.npy, plain NumPy arrays that
+the plugin memory-maps instead of loading them. Values are stored as
+float16: errors are below 32 A and the half precision error is below 0.02 A,
+while the files of large complexes take half the space.
+"""
+import os
+
+ERROR_MATRICES = ('pae', 'pde')
+MATRIX_PATTERN = '%s.model_idx_%d.npy'
+
+
+def saveErrorMatrices(candidates, outputDir):
+    """ Save the error matrices of the StructureCandidates returned by
+    run_inference into outputDir. """
+    import numpy as np
+    for kind in ERROR_MATRICES:
+        matrices = getattr(candidates, kind, None)
+        if matrices is None:
+            continue
+        for i, matrix in enumerate(matrices):
+            fn = os.path.join(outputDir, MATRIX_PATTERN % (kind, i))
+            np.save(fn, matrix.detach().cpu().numpy().astype(np.float16))
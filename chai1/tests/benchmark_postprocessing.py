@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Benchmark of the post-processing of Chai-1 predictions.
+
+Synthetic Chai-1-style mmCIF files and server ZIP archives are generated for
+a range of model sizes and every post-processing stage is timed. Results
+(seconds, atoms per second, peak Python memory and peak RSS of the worker
+processes per stage) are written as JSON, so runs of different plugin
+versions can be compared:
+
+    python -m chai1.tests.benchmark_postprocessing --sizes 1000 100000 1000000 \\
+        --output bench.json
+    python -m chai1.tests.benchmark_postprocessing --compare bench.json
+
+With --compare the exit status is 1 when any stage is slower than the
+baseline by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+import numpy as np
+
+from chai1.convert import (readAtomSite, residueConfidence, writeLddtCif,
+                           writeLddtCifs, lddtSidecarPath, readLddtSidecar)
+from chai1.utils import fileChecksum, readServerArchive
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+NUM_MODELS = 5
+ATOMS_PER_RESIDUE = 8
+RESIDUES_PER_CHAIN = 1000
+RESIDUE_NAMES = ['ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY',
+                 'HIS', 'ILE', 'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER',
+                 'THR', 'TRP', 'TYR', 'VAL']
+ATOM_SITE_COLUMNS = ['group_PDB', 'id', 'type_symbol', 'label_atom_id',
+                     'label_alt_id', 'label_comp_id', 'label_seq_id',
+                     'auth_seq_id', 'pdbx_PDB_ins_code', 'label_asym_id',
+                     'Cartn_x', 'Cartn_y', 'Cartn_z', 'occupancy',
+                     'label_entity_id', 'auth_asym_id', 'B_iso_or_equiv',
+                     'pdbx_PDB_model_num']
+
+
+def chainId(i):
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    return letters[i % 26] * (i // 26 + 1)
+
+
+def writeSyntheticCif(fileName, nAtoms, seed=0, blockSize=100000):
+    """ Write a Chai-1-style mmCIF model with nAtoms ATOM records.
+
+    Chains have RESIDUES_PER_CHAIN residues of ATOMS_PER_RESIDUE atoms and
+    the B-factor column holds a per-atom pLDDT, as written by chai-lab.
+    """
+    rng = np.random.default_rng(seed)
+    with open(fileName, 'w') as f:
+        f.write('data_synthetic\n#\nloop_\n')
+        for column in ATOM_SITE_COLUMNS:
+            f.write(f'_atom_site.{column}\n')
+        for start in range(0, nAtoms, blockSize):
+            ids = np.arange(start, min(start + blockSize, nAtoms))
+            residues = ids // ATOMS_PER_RESIDUE
+            numbers = residues % RESIDUES_PER_CHAIN + 1
+            chains = residues // RESIDUES_PER_CHAIN
+            coords = rng.uniform(-100, 100, size=(len(ids), 3))
+            plddt = rng.uniform(20, 100, size=len(ids))
+            lines = []
+            for i, atomId in enumerate(ids.tolist()):
+                chain = chainId(int(chains[i]))
+                name = RESIDUE_NAMES[int(residues[i]) % len(RESIDUE_NAMES)]
+                x, y, z = coords[i]
+                lines.append(f'ATOM {atomId + 1} C CA . {name} {numbers[i]} '
+                             f'{numbers[i]} ? {chain} {x:.3f} {y:.3f} {z:.3f} '
+                             f'1.00 1 {chain} {plddt[i]:.2f} 1\n')
+            f.writelines(lines)
+        f.write('#\n')
+    return fileName
+
+
+def writeSyntheticZip(fileName, cifFile, nModels=NUM_MODELS):
+    """ Chai-1 server-like archive with nModels copies of cifFile and their
+    summary JSON files. """
+    with zipfile.ZipFile(fileName, 'w', zipfile.ZIP_DEFLATED) as zipRef:
+        for i in range(nModels):
+            zipRef.write(cifFile, f'prediction/pred.model_idx_{i}.cif')
+            zipRef.writestr(f'prediction/summary.model_idx_{i}.json',
+                            json.dumps({'ranking_score': 0.9 - 0.1 * i}))
+    return fileName
+
+
+def stages(workDir, cifFile, zipFile, numberOfWorkers):
+    """ (name, models, setup, run) of every post-processing stage. setup
+    prepares the input files, outside the timed region, and its result is
+    passed to run. """
+    def copy(i=0):
+        fn = os.path.join(workDir, f'model_{i}.cif')
+        shutil.copyfile(cifFile, fn)
+        return fn
+
+    def copyModels():
+        return [copy(i) for i in range(NUM_MODELS)]
+
+    def sidecar():
+        fn = copy()
+        writeLddtCif(fn, fn, lddtSidecarPath(fn), rewrite=False)
+        return lddtSidecarPath(fn)
+
+    def rewrite(fn):
+        writeLddtCif(fn, fn, lddtSidecarPath(fn))
+
+    def scan(fn):
+        writeLddtCif(fn, fn, lddtSidecarPath(fn), rewrite=False)
+
+    def rewriteCompressed(fn):
+        writeLddtCif(fn, fn + '.gz', lddtSidecarPath(fn))
+
+    def rewriteModels(fileNames):
+        jobs = [(fn, fn, lddtSidecarPath(fn)) for fn in fileNames]
+        writeLddtCifs(jobs, numberOfWorkers=numberOfWorkers)
+
+    def importZip(_):
+        # Post-processing of Chai1Protocol._getModelFromCIF with the default
+        # options: checksum, archive listing and sidecars of the members,
+        # which are extracted unchanged
+        fileChecksum(zipFile)
+        members, _ = readServerArchive(zipFile)
+        jobs = []
+        for member in members:
+            outFile = os.path.join(workDir, 'server_' + os.path.basename(member))
+            jobs.append(((zipFile, member), outFile, lddtSidecarPath(outFile)))
+        writeLddtCifs(jobs, numberOfWorkers=numberOfWorkers, rewrite=False)
+
+    def readSidecar(fn):
+        residues = readLddtSidecar(fn)
+        float(residues['lddt'].mean())
+
+    def noSetup():
+        return None
+
+    return [
+        ('readAtomSite', 1, noSetup,
+         lambda _: residueConfidence(readAtomSite(cifFile))),
+        ('writeLddtCif', 1, copy, rewrite),
+        ('writeLddtCifGz', 1, copy, rewriteCompressed),
+        ('scanLddtCif', 1, copy, scan),
+        ('writeLddtCifs', NUM_MODELS, copyModels, rewriteModels),
+        ('importServerZip', NUM_MODELS, noSetup, importZip),
+        ('readLddtSidecar', 1, sidecar, readSidecar),
+    ]
+
+
+def childrenPeakRss():
+    """ Largest peak RSS in MB of the terminated child processes, such as
+    the process pool workers. It never decreases and a child starts from the
+    RSS of this process when it is forked. """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+def measure(setup, run, repeat):
+    """ Best wall time of repeat runs and peak traced memory of one run.
+    tracemalloc only traces the calling process, the process pool workers
+    are measured by childrenPeakRss. """
+    times = []
+    for _ in range(repeat):
+        arg = setup()
+        start = time.perf_counter()
+        run(arg)
+        times.append(time.perf_counter() - start)
+    arg = setup()
+    tracemalloc.start()
+    run(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def runBenchmark(sizes, repeat=3, numberOfWorkers=NUM_MODELS, workDir=None,
+                 only=None):
+    results = []
+    workDir = workDir or tempfile.mkdtemp(prefix='chai1-bench-')
+    try:
+        for nAtoms in sizes:
+            cifFile = writeSyntheticCif(os.path.join(workDir, f'synthetic_{nAtoms}.cif'),
+                                        nAtoms)
+            zipFile = writeSyntheticZip(os.path.join(workDir, f'synthetic_{nAtoms}.zip'),
+                                        cifFile)
+            for name, models, setup, run in stages(workDir, cifFile, zipFile,
+                                                   numberOfWorkers):
+                if only and name not in only:
+                    continue
+                seconds, peak = measure(setup, run, repeat)
+                childrenRss = childrenPeakRss()
+                results.append({'stage': name,
+                                'atoms': nAtoms,
+                                'models': models,
+                                'seconds': seconds,
+                                'atomsPerSecond': nAtoms * models / seconds if seconds else None,
+                                'peakMemoryMB': peak / 1024 ** 2,
+                                'childrenPeakRssMB': childrenRss})
+                print(f"{name:16s} {nAtoms:>9d} atoms  {seconds:9.4f} s  "
+                      f"{peak / 1024 ** 2:9.1f} MB  {childrenRss:9.1f} MB "
+                      f"children RSS")
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Print the time ratio of every stage against the baseline and
+    return the stages slower than (1 + tolerance) times the baseline. """
+    reference = {(r['stage'], r['atoms']): r['seconds']
+                 for r in baseline['results']}
+    regressions = []
+    for r in results:
+        key = (r['stage'], r['atoms'])
+        if key not in reference or not reference[key]:
+            continue
+        ratio = r['seconds'] / reference[key]
+        print(f"{r['stage']:16s} {r['atoms']:>9d} atoms  x{ratio:6.2f}")
+        if ratio > 1 + tolerance:
+            regressions.append(key)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Number of atoms of the synthetic models')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=NUM_MODELS,
+                        help='Process pool size for the multi-model stages')
+    parser.add_argument('--stages', nargs='+',
+                        help='Run only these stages, all by default')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown against --compare (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    from chai1 import __version__
+    report = {'plugin': __version__,
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'machine': platform.machine(),
+              'cpus': os.cpu_count(),
+              'results': runBenchmark(args.sizes, args.repeat, args.workers,
+                                            only=args.stages)}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report['results'], json.load(f), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stages slower than the baseline: {regressions}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
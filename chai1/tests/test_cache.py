@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Tests of the prediction cache and the MSA store.
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from chai1.cache import (MSA_SUFFIX, USED_MARKER, MsaStore, PredictionCache,
+                         predictionKey, sequenceHash)
+
+ENTRY_SIZE = 1000  # bytes of every cached file
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='chai1-cache-')
+        self.addCleanup(shutil.rmtree, self.tmpDir, ignore_errors=True)
+
+    def _path(self, *paths):
+        return os.path.join(self.tmpDir, *paths)
+
+    def _write(self, fileName, content):
+        os.makedirs(os.path.dirname(fileName), exist_ok=True)
+        with open(fileName, 'w') as f:
+            f.write(content)
+        return fileName
+
+    @staticmethod
+    def _age(fileName, seconds):
+        """ Mark fileName as used seconds ago. """
+        past = time.time() - seconds
+        os.utime(fileName, (past, past))
+
+
+class TestPredictionKey(CacheTestCase):
+
+    def _key(self, content, version='0.6.1', options=None):
+        return predictionKey(self._write(self._path('input.fasta'), content),
+                             version, options)
+
+    def test_canonicalFasta(self):
+        key = self._key('>protein|name=A\nMKTAYIAK\n>ligand|name=L\nCCO\n')
+        # Record names, line wrapping, blanks and protein case do not count
+        self.assertEqual(key, self._key('>protein|name=other\nmkta\n YIAK \n\n'
+                                        '>LIGAND|name=L\nCCO\n'))
+        # The order of the records does
+        self.assertNotEqual(key, self._key('>ligand|name=L\nCCO\n'
+                                           '>protein|name=A\nMKTAYIAK\n'))
+
+    def test_ligandCase(self):
+        # c1ccccc1 (aromatic) and C1CCCCC1 (aliphatic) are different ligands
+        aromatic = self._key('>protein|name=A\nMKTAYIAK\n>ligand|name=L\nc1ccccc1\n')
+        aliphatic = self._key('>protein|name=A\nMKTAYIAK\n>ligand|name=L\nC1CCCCC1\n')
+        self.assertNotEqual(aromatic, aliphatic)
+
+    def test_versionAndOptions(self):
+        content = '>protein|name=A\nMKTAYIAK\n'
+        key = self._key(content, options={'seed': 1, 'num_trunk_recycles': 3})
+        self.assertEqual(key, self._key(content, options={'num_trunk_recycles': 3,
+                                                          'seed': 1}))
+        self.assertNotEqual(key, self._key(content, options={'seed': 2,
+                                                             'num_trunk_recycles': 3}))
+        self.assertNotEqual(key, self._key(content, version='0.6.0',
+                                           options={'seed': 1,
+                                                    'num_trunk_recycles': 3}))
+        self.assertEqual(self._key(content), self._key(content, options={}))
+
+
+class TestPredictionCache(CacheTestCase):
+
+    def _outputs(self, name):
+        outputDir = self._path('run_' + name)
+        return [self._write(os.path.join(outputDir, fn), name * ENTRY_SIZE)
+                for fn in ('pred.model_idx_0.cif', 'scores.model_idx_0.npz')]
+
+    def _marker(self, cache, key):
+        return os.path.join(cache.root, key, USED_MARKER)
+
+    def test_putGet(self):
+        cache = PredictionCache(self._path('cache'), 10 * ENTRY_SIZE)
+        self.assertEqual(cache.get('a', self._path('out')), [])
+        cache.put('a', self._outputs('a'))
+        files = cache.get('a', self._path('out'))
+        self.assertEqual([os.path.basename(fn) for fn in files],
+                         ['pred.model_idx_0.cif', 'scores.model_idx_0.npz'])
+        with open(files[0]) as f:
+            self.assertEqual(f.read(), 'a' * ENTRY_SIZE)
+
+    def test_evictLeastRecentlyUsed(self):
+        # Room for two entries of two files
+        cache = PredictionCache(self._path('cache'), 5 * ENTRY_SIZE)
+        cache.put('a', self._outputs('a'))
+        cache.put('b', self._outputs('b'))
+        self._age(self._marker(cache, 'a'), 200)
+        self._age(self._marker(cache, 'b'), 100)
+
+        cache.get('a', self._path('out'))  # a is now the most recently used
+        cache.put('c', self._outputs('c'))
+        self.assertEqual(sorted(os.listdir(cache.root)), ['a', 'c'])
+
+
+class TestMsaStore(CacheTestCase):
+
+    SEQUENCES = ['MKTAYIAK', 'GSHMLEDP', 'PEPTIDE']
+
+    def _msaDir(self, sequences):
+        msaDir = self._path('msas_%d' % len(os.listdir(self.tmpDir)))
+        for seq in sequences:
+            self._write(os.path.join(msaDir, sequenceHash(seq) + MSA_SUFFIX),
+                        seq[0] * ENTRY_SIZE)
+        return msaDir
+
+    def _storedFile(self, store, seq):
+        return os.path.join(store.root, sequenceHash(seq) + MSA_SUFFIX)
+
+    def test_putGet(self):
+        store = MsaStore(self._path('store'), 10 * ENTRY_SIZE)
+        self.assertEqual(store.put(self._msaDir(self.SEQUENCES[:2])), 2)
+        self.assertEqual(store.put(self._msaDir(self.SEQUENCES[:2])), 0)
+        self.assertTrue(store.contains(self.SEQUENCES[0].lower()))
+        self.assertFalse(store.contains(self.SEQUENCES[2]))
+
+        msaDir = self._path('msa_input')
+        found = store.get(self.SEQUENCES, msaDir)
+        self.assertEqual(sorted(found),
+                         sorted(sequenceHash(seq) for seq in self.SEQUENCES[:2]))
+        self.assertEqual(sorted(os.listdir(msaDir)),
+                         sorted(seqHash + MSA_SUFFIX for seqHash in found))
+
+    def test_evictLeastRecentlyUsed(self):
+        # Room for two MSAs
+        store = MsaStore(self._path('store'), 2.5 * ENTRY_SIZE)
+        first, second, third = self.SEQUENCES
+        store.put(self._msaDir([first, second]))
+        self._age(self._storedFile(store, first), 200)
+        self._age(self._storedFile(store, second), 100)
+
+        store.get([first], self._path('msa_input'))  # first is now the newest
+        store.put(self._msaDir([third]))
+        self.assertTrue(store.contains(first))
+        self.assertFalse(store.contains(second))
+        self.assertTrue(store.contains(third))
+
+
+if __name__ == '__main__':
+    unittest.main()
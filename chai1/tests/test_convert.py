@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Tests of the conversion helpers on synthetic Chai-1 models, they need
+neither chai-lab nor a GPU.
+"""
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+import numpy as np
+
+from chai1.convert import (LDDT_HEADER, SCORE_AGGREGATE, SCORE_CLASHES,
+                           SCORE_IPTM, SCORE_PTM, lddtDefattrPath,
+                           lddtSidecarPath, openText, writeLddtDefattr,
+                           rankModels, readAtomSite, readLddtSidecar,
+                           readScores, residueConfidence, scoresPath,
+                           writeLddtCif, writeLddtCifs)
+from chai1.tests.benchmark_postprocessing import (ATOMS_PER_RESIDUE,
+                                                  RESIDUES_PER_CHAIN,
+                                                  writeSyntheticCif,
+                                                  writeSyntheticZip)
+
+# Two full chains and a last residue with half of its atoms
+NUM_ATOMS = (2 * RESIDUES_PER_CHAIN + 1) * ATOMS_PER_RESIDUE + ATOMS_PER_RESIDUE // 2
+
+# Consecutive residues that only differ in the chain, and a ligand
+SMALL_CIF = """data_small
+#
+loop_
+_atom_site.group_PDB
+_atom_site.label_comp_id
+_atom_site.label_seq_id
+_atom_site.label_asym_id
+_atom_site.Cartn_x
+_atom_site.Cartn_y
+_atom_site.Cartn_z
+_atom_site.B_iso_or_equiv
+ATOM GLY 1 A 0.000 0.000 0.000 10.00
+ATOM GLY 1 A 1.000 0.000 0.000 30.00
+ATOM ALA 1 B 2.000 0.000 0.000 50.00
+ATOM ALA 2 B 3.000 0.000 0.000 70.00
+ATOM ALA 2 B 4.000 0.000 0.000 90.00
+HETATM LIG . C 5.000 0.000 0.000 40.00
+#
+"""
+
+# SMALL_CIF with the columns after group_PDB in another order and an extra
+# one, as other mmCIF writers may do
+REORDERED_CIF = """data_server
+loop_
+_atom_site.group_PDB
+_atom_site.B_iso_or_equiv
+_atom_site.Cartn_z
+_atom_site.label_asym_id
+_atom_site.id
+_atom_site.Cartn_y
+_atom_site.Cartn_x
+_atom_site.label_seq_id
+_atom_site.label_comp_id
+ATOM 10.00 0.000 A 1 0.000 0.000 1 GLY
+ATOM 30.00 0.000 A 2 0.000 1.000 1 GLY
+ATOM 50.00 0.000 B 3 0.000 2.000 1 ALA
+ATOM 70.00 0.000 B 4 0.000 3.000 2 ALA
+ATOM 90.00 0.000 B 5 0.000 4.000 2 ALA
+HETATM 40.00 0.000 C 6 0.000 5.000 . LIG
+"""
+
+
+class ConvertTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='chai1-convert-')
+        self.addCleanup(shutil.rmtree, self.tmpDir, ignore_errors=True)
+        self.cifFile = writeSyntheticCif(self._path('model.cif'), NUM_ATOMS)
+
+    def _path(self, fileName):
+        return os.path.join(self.tmpDir, fileName)
+
+    def _write(self, fileName, content):
+        with open(self._path(fileName), 'w') as f:
+            f.write(content)
+        return self._path(fileName)
+
+    def _read(self, source):
+        with openText(source) as f:
+            return f.read()
+
+
+class TestWriteLddtCif(ConvertTestCase):
+
+    def test_residueMeans(self):
+        cifFile = self._write('small.cif', SMALL_CIF)
+        outFile = self._path('out.cif')
+        lddtFile = self._path('out_lddt.npy')
+        aminoAcids, lddtValues = writeLddtCif(cifFile, outFile, lddtFile,
+                                              chunkSize=1)
+        self.assertEqual(aminoAcids, ['GLY', 'ALA', 'ALA'])
+        np.testing.assert_allclose(lddtValues, [20, 50, 80])
+
+        residues = readLddtSidecar(lddtFile)
+        self.assertEqual(residues['chain'].tolist(), [b'A', b'B', b'B'])
+        self.assertEqual(residues['number'].tolist(), [1, 1, 2])
+        np.testing.assert_allclose(residues['lddt'], [20, 50, 80])
+
+        np.testing.assert_allclose(readAtomSite(outFile)['bfactor'],
+                                   [20, 20, 50, 80, 80])
+        # Only ATOM records are averaged
+        np.testing.assert_allclose(
+            readAtomSite(outFile, groups=('HETATM',))['bfactor'], [40])
+
+    def test_chunkBoundaries(self):
+        outFile = self._path('out.cif')
+        aminoAcids, lddtValues = writeLddtCif(self.cifFile, outFile)
+        expected = self._read(outFile)
+        refAminoAcids, refValues = residueConfidence(readAtomSite(self.cifFile))
+        self.assertEqual(aminoAcids, refAminoAcids.astype(str).tolist())
+        np.testing.assert_allclose(lddtValues, refValues)
+
+        for chunkSize in (1, ATOMS_PER_RESIDUE - 1, ATOMS_PER_RESIDUE,
+                          ATOMS_PER_RESIDUE + 1, 1000):
+            with self.subTest(chunkSize=chunkSize):
+                result = writeLddtCif(self.cifFile, outFile, chunkSize=chunkSize)
+                self.assertEqual(result, (aminoAcids, lddtValues))
+                self.assertEqual(self._read(outFile), expected)
+
+    def test_replaceLddtLoop(self):
+        outFile = self._path('out.cif')
+        expected = writeLddtCif(self.cifFile, outFile)
+        atoms, _ = self._read(outFile).split(LDDT_HEADER)
+
+        # Rewriting a rewritten model replaces its LDDT loop
+        result = writeLddtCif(outFile, outFile)
+        content = self._read(outFile)
+        self.assertEqual(content.count(LDDT_HEADER), 1)
+        self.assertEqual(content.split(LDDT_HEADER)[0], atoms)
+        self.assertEqual(result[0], expected[0])
+        np.testing.assert_allclose(result[1], expected[1])
+
+    def test_compressedSources(self):
+        outFile = self._path('out.cif')
+        writeLddtCif(self.cifFile, outFile)
+        expected = self._read(outFile)
+
+        gzFile = self._path('model.cif.gz')
+        with open(self.cifFile, 'rb') as fIn, gzip.open(gzFile, 'wb') as fOut:
+            shutil.copyfileobj(fIn, fOut)
+        zipFile = writeSyntheticZip(self._path('server.zip'), self.cifFile,
+                                    nModels=1)
+        with zipfile.ZipFile(zipFile, 'a') as zipRef:
+            zipRef.write(gzFile, 'prediction/model.cif.gz')
+
+        sources = [gzFile, (zipFile, 'prediction/pred.model_idx_0.cif'),
+                   (zipFile, 'prediction/model.cif.gz')]
+        for source in sources:
+            for outName in ('out.cif', 'out.cif.gz'):
+                with self.subTest(source=source, outName=outName):
+                    outFile = self._path(outName)
+                    writeLddtCif(source, outFile)
+                    self.assertEqual(self._read(outFile), expected)
+                    with open(outFile, 'rb') as f:
+                        self.assertEqual(f.read(2) == b'\x1f\x8b',
+                                         outName.endswith('.gz'))
+
+
+class TestWriteLddtCifs(ConvertTestCase):
+
+    def _jobs(self):
+        jobs = []
+        for i in range(3):
+            fn = self._path(f'pred.model_idx_{i}.cif')
+            shutil.copyfile(self.cifFile, fn)
+            jobs.append((fn, fn, lddtSidecarPath(fn)))
+        return jobs
+
+    def test_sidecarPaths(self):
+        refFile = self._path('ref.cif')
+        writeLddtCif(self.cifFile, refFile, lddtSidecarPath(refFile))
+        expected = np.array(readLddtSidecar(lddtSidecarPath(refFile)))
+
+        jobs = self._jobs()
+        with mock.patch('chai1.convert.usableCpus', return_value=2):
+            self.assertEqual(writeLddtCifs(jobs, numberOfWorkers=2),
+                             [job[2] for job in jobs])
+        for _, _, lddtFile in jobs:
+            np.testing.assert_array_equal(readLddtSidecar(lddtFile), expected)
+
+    def test_serialWithoutSpareCpus(self):
+        jobs = self._jobs()
+        with mock.patch('chai1.convert.usableCpus', return_value=1), \
+                mock.patch('chai1.convert.ProcessPoolExecutor') as pool:
+            writeLddtCifs(jobs, numberOfWorkers=4, rewrite=False)
+        pool.assert_not_called()
+        for _, _, lddtFile in jobs:
+            self.assertTrue(os.path.exists(lddtFile))
+
+
+class TestReadAtomSite(ConvertTestCase):
+
+    def _assertSmallAtoms(self, atoms):
+        self.assertEqual(atoms['chain'].tolist(), [b'A', b'A', b'B', b'B', b'B'])
+        self.assertEqual(atoms['number'].tolist(), [1, 1, 1, 2, 2])
+        self.assertEqual(atoms['name'].tolist(), [b'GLY'] * 2 + [b'ALA'] * 3)
+        np.testing.assert_allclose(atoms['bfactor'], [10, 30, 50, 70, 90])
+        np.testing.assert_allclose(atoms['coords'][:, 0], [0, 1, 2, 3, 4])
+        self.assertEqual(atoms['coords'].shape, (5, 3))
+
+    def test_columns(self):
+        for fileName, content in (('small.cif', SMALL_CIF),
+                                  ('server.cif', REORDERED_CIF)):
+            with self.subTest(fileName=fileName):
+                atoms = readAtomSite(self._write(fileName, content))
+                self._assertSmallAtoms(atoms)
+
+    def test_groups(self):
+        cifFile = self._write('small.cif', SMALL_CIF)
+        ligand = readAtomSite(cifFile, groups=('HETATM',))
+        self.assertEqual(ligand['name'].tolist(), [b'LIG'])
+        self.assertEqual(ligand['number'].tolist(), [0])  # '.'
+        both = readAtomSite(cifFile, groups=('ATOM', 'HETATM'))
+        self.assertEqual(len(both['number']), 6)
+
+    def test_syntheticModel(self):
+        atoms = readAtomSite(self.cifFile)
+        self.assertEqual(len(atoms['number']), NUM_ATOMS)
+        self.assertEqual(atoms['chain'][[0, -1]].tolist(), [b'A', b'C'])
+        aminoAcids, lddtValues = residueConfidence(atoms)
+        self.assertEqual(len(lddtValues), -(-NUM_ATOMS // ATOMS_PER_RESIDUE))
+
+    def test_errors(self):
+        emptyFile = self._write('empty.cif', 'data_empty\n#\n')
+        with self.assertRaisesRegex(Exception, 'No _atom_site loop'):
+            readAtomSite(emptyFile)
+        noChain = self._write('nochain.cif', SMALL_CIF.replace(
+            '_atom_site.label_asym_id', '_atom_site.auth_asym_id'))
+        with self.assertRaisesRegex(Exception, 'label_asym_id'):
+            readAtomSite(noChain)
+
+    def test_sidecarOnly(self):
+        """ rewrite=False leaves the model as written by chai-lab and writes
+        the same sidecar as a rewrite. """
+        outFile = self._path('out.cif')
+        expected = writeLddtCif(self.cifFile, outFile, lddtSidecarPath(outFile))
+        expectedSidecar = np.array(readLddtSidecar(lddtSidecarPath(outFile)))
+
+        for outName in ('copy.cif', 'copy.cif.gz'):
+            with self.subTest(outName=outName):
+                outFile = self._path(outName)
+                result = writeLddtCif(self.cifFile, outFile,
+                                      lddtSidecarPath(outFile), rewrite=False)
+                self.assertEqual(result[0], expected[0])
+                np.testing.assert_allclose(result[1], expected[1])
+                self.assertEqual(self._read(outFile), self._read(self.cifFile))
+                sidecar = readLddtSidecar(lddtSidecarPath(outFile))
+                np.testing.assert_array_equal(sidecar, expectedSidecar)
+
+        # In place, the model is only read
+        before = os.stat(self.cifFile).st_mtime_ns
+        writeLddtCif(self.cifFile, self.cifFile, rewrite=False)
+        self.assertEqual(os.stat(self.cifFile).st_mtime_ns, before)
+
+    def test_sidecarOnlyReadsOnce(self):
+        """ A server ZIP member is decompressed once to parse and copy it. """
+        zipFile = writeSyntheticZip(self._path('server.zip'), self.cifFile,
+                                    nModels=1)
+        member = 'prediction/pred.model_idx_0.cif'
+        opened = []
+        zipOpen = zipfile.ZipFile.open
+
+        def countingOpen(zipRef, name, *args, **kwargs):
+            opened.append(name)
+            return zipOpen(zipRef, name, *args, **kwargs)
+
+        for outName in ('copy.cif', 'copy.cif.gz'):
+            with self.subTest(outName=outName):
+                del opened[:]
+                outFile = self._path(outName)
+                with mock.patch.object(zipfile.ZipFile, 'open', countingOpen):
+                    writeLddtCif((zipFile, member), outFile,
+                                 lddtSidecarPath(outFile), rewrite=False)
+                self.assertEqual(opened, [member])
+                self.assertEqual(self._read(outFile), self._read(self.cifFile))
+
+
+class TestLddtDefattr(ConvertTestCase):
+
+    def test_modelSpec(self):
+        cifFile = self._write('small.cif', SMALL_CIF)
+        sidecar = lddtSidecarPath(cifFile)
+        writeLddtCif(cifFile, cifFile, sidecar)
+
+        self.assertEqual(lddtDefattrPath(cifFile), self._path('small_lddt.defattr'))
+        self.assertEqual(lddtDefattrPath(cifFile, 2),
+                         self._path('small_lddt.2.defattr'))
+        header = 'attribute: lddt\nrecipient: residues\nmatch mode: any\n'
+        for modelId, spec in ((None, ''), (2, '#2')):
+            with self.subTest(modelId=modelId):
+                defattrFile = lddtDefattrPath(cifFile, modelId)
+                writeLddtDefattr(sidecar, defattrFile, modelId)
+                self.assertEqual(self._read(defattrFile),
+                                 header +
+                                 f'\t{spec}/A:1\t20.00\n'
+                                 f'\t{spec}/B:1\t50.00\n'
+                                 f'\t{spec}/B:2\t80.00\n')
+
+
+class TestRankModels(ConvertTestCase):
+
+    def _writeScores(self, index, aggregate, clashes=False):
+        """ Scores of a model as saved by chai-lab, one value per field. """
+        fileName = scoresPath(self._path(f'pred.model_idx_{index}.cif'))
+        np.savez(fileName, aggregate_score=np.array([aggregate]),
+                 ptm=np.array([0.5]), iptm=np.array([0.6]),
+                 has_inter_chain_clashes=np.array([clashes]))
+        return fileName
+
+    def test_readScores(self):
+        scoreFiles = [self._writeScores(0, 0.7),
+                      self._writeScores(1, 0.9, clashes=True),
+                      self._path('scores.model_idx_2.npz')]  # missing
+        scores = readScores(scoreFiles)
+        np.testing.assert_allclose(scores[SCORE_AGGREGATE], [0.7, 0.9, np.nan])
+        np.testing.assert_allclose(scores[SCORE_PTM], [0.5, 0.5, np.nan])
+        np.testing.assert_allclose(scores[SCORE_IPTM], [0.6, 0.6, np.nan])
+        self.assertEqual(scores[SCORE_CLASHES].tolist(), [False, True, False])
+
+    def test_rankModels(self):
+        scoreFiles = [self._writeScores(0, 0.7),
+                      self._writeScores(1, 0.95, clashes=True),
+                      self._path('scores.model_idx_2.npz'),
+                      self._writeScores(3, 0.8),
+                      self._writeScores(4, 0.6, clashes=True)]
+        # No clashes first, then by score, models without scores last
+        self.assertEqual(rankModels(readScores(scoreFiles)).tolist(),
+                         [3, 0, 1, 4, 2])
+
+    def test_rankTies(self):
+        # Equal scores keep the order of the models
+        scoreFiles = [self._writeScores(i, 0.5) for i in range(3)]
+        self.assertEqual(rankModels(readScores(scoreFiles)).tolist(), [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
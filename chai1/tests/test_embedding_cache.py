@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Tests of the ESM embedding cache of the fold scripts, with stub chai-lab
+and torch modules, so they run without chai-lab or a GPU.
+"""
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from chai1.scripts import embedding_cache
+
+ESM_URL = 'https://example.org/esm2/traced_sdpa_esm2_t36_3B_UR50D_fp16.pt'
+
+
+class FakeTensor:
+    """ The part of the torch.Tensor API used by the cache. """
+
+    def __init__(self, array):
+        self.array = np.asarray(array)
+
+    def detach(self):
+        return self
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+
+class EmbeddingContext:
+
+    def __init__(self, esm_embeddings):
+        self.esm_embeddings = esm_embeddings
+
+
+def _stubModules(embedded):
+    """ sys.modules entries of a chai-lab whose ESM embedding records the
+    sequences it is called with in embedded. """
+    def getEsmContexts(prot_sequences, device):
+        embedded.extend(sorted(prot_sequences))
+        return {seq: EmbeddingContext(FakeTensor(
+                    np.full((len(seq), 4), len(seq), dtype=np.float32)))
+                for seq in prot_sequences}
+
+    esm = types.ModuleType('chai_lab.data.dataset.embeddings.esm')
+    esm.ESM_URL = ESM_URL
+    esm.EmbeddingContext = EmbeddingContext
+    esm._get_esm_contexts_for_sequences = getEsmContexts
+    modules = {name: types.ModuleType(name)
+               for name in ['chai_lab', 'chai_lab.data',
+                            'chai_lab.data.dataset',
+                            'chai_lab.data.dataset.embeddings']}
+    modules['chai_lab.data.dataset.embeddings'].esm = esm
+    modules[esm.__name__] = esm
+    modules['torch'] = types.SimpleNamespace(from_numpy=FakeTensor)
+    return modules
+
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='chai1-emb-')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.embedded = []
+        self.modules = _stubModules(self.embedded)
+        patcher = mock.patch.dict(sys.modules, self.modules)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        embedding_cache._installed.clear()
+        self.addCleanup(embedding_cache._installed.clear)
+
+    def _esm(self):
+        return self.modules['chai_lab.data.dataset.embeddings.esm']
+
+    def _embed(self, sequences):
+        return self._esm()._get_esm_contexts_for_sequences(
+            prot_sequences=set(sequences), device='cpu')
+
+    def test_hitSkipsOriginal(self):
+        self.assertTrue(embedding_cache.install(self.root, 1e9))
+        first = self._embed(['MKV', 'GGSA'])
+        self.assertEqual(self.embedded, ['GGSA', 'MKV'])
+
+        second = self._embed(['MKV', 'GGSA', 'WW'])
+        self.assertEqual(self.embedded, ['GGSA', 'MKV', 'WW'])
+        for seq in ('MKV', 'GGSA'):
+            self.assertIsInstance(second[seq], EmbeddingContext)
+            np.testing.assert_array_equal(second[seq].esm_embeddings.array,
+                                          first[seq].esm_embeddings.array)
+
+    def test_installTwice(self):
+        self.assertTrue(embedding_cache.install(self.root, 1e9))
+        wrapper = self._esm()._get_esm_contexts_for_sequences
+        self.assertTrue(embedding_cache.install(self.root, 1e9))
+        self.assertIs(self._esm()._get_esm_contexts_for_sequences, wrapper)
+
+    def test_keyedOnEsmModel(self):
+        cache = embedding_cache.EmbeddingCache(self.root, 1e9, 'esm-a')
+        cache.put('MKV', np.zeros((3, 4), dtype=np.float32))
+        self.assertIsNotNone(cache.get('MKV'))
+        other = embedding_cache.EmbeddingCache(self.root, 1e9, 'esm-b')
+        self.assertIsNone(other.get('MKV'))
+
+    def test_missingFunction(self):
+        del self._esm()._get_esm_contexts_for_sequences
+        self.assertFalse(embedding_cache.install(self.root, 1e9))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Check that importing the plugin, as Scipion does when it discovers the
+protocols, stays fast and does not load the heavy optional dependencies.
+"""
+import json
+import subprocess
+import sys
+import unittest
+
+# Seconds that importing the plugin may add on top of pwem itself
+IMPORT_BUDGET = 0.5
+
+# Modules that must only be imported when a feature needs them
+DEFERRED_MODULES = ['requests', 'matplotlib', 'chimera']
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+%(base)s
+middle = time.perf_counter()
+baseModules = set(sys.modules)
+%(plugin)s
+end = time.perf_counter()
+print(json.dumps({'base': middle - start, 'plugin': end - middle,
+                  'modules': sorted(set(sys.modules) - baseModules)}))
+"""
+
+
+def importModules(base, plugin):
+    """ Import base and then plugin in a fresh interpreter and return the
+    time of each import and the modules added by the plugin import, so
+    what base loads by itself is not blamed on the plugin. """
+    script = _IMPORT_SCRIPT % {'base': base, 'plugin': plugin}
+    output = subprocess.check_output([sys.executable, '-c', script], text=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class TestImports(unittest.TestCase):
+
+    def _assertNotImported(self, modules, names):
+        for name in names:
+            loaded = [m for m in modules if m == name or m.startswith(name + '.')]
+            self.assertFalse(loaded, f"{name} is imported eagerly: {loaded}")
+
+    def test_protocols(self):
+        result = importModules('import pwem.protocols',
+                               'import chai1, chai1.protocols')
+        self._assertNotImported(result['modules'], DEFERRED_MODULES)
+        self.assertLess(result['plugin'], IMPORT_BUDGET,
+                        f"Importing chai1.protocols took {result['plugin']:.2f} s")
+
+    def test_viewers(self):
+        result = importModules('import pwem.viewers', 'import chai1.viewers')
+        self._assertNotImported(result['modules'], DEFERRED_MODULES)
+        self.assertLess(result['plugin'], IMPORT_BUDGET,
+                        f"Importing chai1.viewers took {result['plugin']:.2f} s")
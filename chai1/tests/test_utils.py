@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Tests of the FASTA fetcher against a local HTTP server that stands in for
+RCSB, so they run offline.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from chai1.utils import FastaFetcher
+
+# RCSB-style FASTA of an entry
+RCSB_FASTA = (">%s_1|Chains A, B|Hemoglobin subunit alpha|Homo sapiens (9606)\n"
+              "MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHF\n")
+CHAI_FASTA = ">protein|Hemoglobin subunit alpha\n" \
+             "MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHF\n"
+
+
+class _FastaHandler(BaseHTTPRequestHandler):
+    """ Answer /fasta/entry/<pdbId> with RCSB_FASTA, or with a 503 while
+    the entry has pending failures. Connections are kept alive. """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        pdbId = self.path.rsplit('/', 1)[-1]
+        with self.server.lock:
+            self.server.requests.append(pdbId)
+            failing = self.server.failures.get(pdbId, 0) > 0
+            if failing:
+                self.server.failures[pdbId] -= 1
+        if failing:
+            self._send(503, b'Service unavailable\n')
+        else:
+            self._send(200, (RCSB_FASTA % pdbId).encode())
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFastaFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='chai1-fasta-')
+        self.addCleanup(shutil.rmtree, self.tmpDir, ignore_errors=True)
+        # Never send the requests to a proxy
+        patcher = mock.patch.dict(os.environ, {'NO_PROXY': '127.0.0.1',
+                                               'no_proxy': '127.0.0.1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _FastaHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.failures = {}
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/fasta/entry/%%s' % self.server.server_port
+
+    def _fetcher(self, **kwargs):
+        kwargs.setdefault('cacheDir', os.path.join(self.tmpDir, 'cache'))
+        fetcher = FastaFetcher(url=self.url, **kwargs)
+        self.addCleanup(lambda: fetcher._session and fetcher._session.close())
+        return fetcher
+
+    def _output(self, pdbId):
+        return os.path.join(self.tmpDir, pdbId + '.fasta')
+
+    def _read(self, fileName):
+        with open(fileName) as f:
+            return f.read()
+
+    def test_reformat(self):
+        outputPath = self._fetcher(cacheDir=None).fetch('1ABC', self._output('1ABC'))
+        self.assertEqual(self._read(outputPath), CHAI_FASTA)
+
+    def test_fetchManyReusesConnection(self):
+        fetcher = self._fetcher(maxWorkers=1)
+        pdbIds = ['1ABC', '2DEF', '3GHI']
+        outputs = fetcher.fetchMany([(pdbId, self._output(pdbId))
+                                     for pdbId in pdbIds])
+        self.assertEqual(outputs, [self._output(pdbId) for pdbId in pdbIds])
+        self.assertEqual(sorted(self.server.requests), pdbIds)
+        self.assertEqual(self.server.connections, 1)
+        for outputPath in outputs:
+            self.assertEqual(self._read(outputPath), CHAI_FASTA)
+
+    def test_cacheHit(self):
+        fetcher = self._fetcher()
+        fetcher.fetch('1ABC', self._output('first'))
+        # A new fetcher with the same cache, as in a later run
+        outputPath = self._fetcher().fetch('1abc', self._output('second'))
+        self.assertEqual(self.server.requests, ['1ABC'])
+        self.assertEqual(self._read(outputPath), CHAI_FASTA)
+
+    def test_expiredEntry(self):
+        fetcher = self._fetcher(ttl=3600)
+        fetcher.fetch('1ABC', self._output('first'))
+        cached = os.path.join(fetcher.cacheDir, '1ABC.fasta')
+        past = time.time() - 7200
+        os.utime(cached, (past, past))
+        fetcher.fetch('1ABC', self._output('second'))
+        self.assertEqual(self.server.requests, ['1ABC', '1ABC'])
+        self.assertGreater(os.path.getmtime(cached), past)
+
+    def test_retryServerError(self):
+        self.server.failures['1ABC'] = 1
+        outputPath = self._fetcher(retries=2).fetch('1ABC', self._output('1ABC'))
+        self.assertEqual(self.server.requests, ['1ABC', '1ABC'])
+        self.assertEqual(self._read(outputPath), CHAI_FASTA)
+
+    def test_serverErrorExhaustsRetries(self):
+        self.server.failures['1ABC'] = 3
+        fetcher = self._fetcher(cacheDir=None, retries=1)
+        with self.assertRaises(Exception):
+            fetcher.fetch('1ABC', self._output('1ABC'))
+        self.assertFalse(os.path.exists(self._output('1ABC')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Tests of the ChimeraX script written by the Chai-1 viewer.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from chai1.convert import (lddtDefattrPath, lddtSidecarPath, writeLddtCif,
+                           writeLddtDefattr)
+from chai1.tests.benchmark_postprocessing import writeSyntheticCif
+from chai1.viewers.viewers import chimeraModelCommands
+
+# ChimeraX commands the model script may use
+CHIMERAX_COMMANDS = {'open', 'color', 'hide'}
+
+
+class TestChimeraModelCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='chai1-viewer-')
+        self.addCleanup(shutil.rmtree, self.tmpDir, ignore_errors=True)
+        self.fileNames = []
+        for i in range(3):
+            cifFile = writeSyntheticCif(
+                os.path.join(self.tmpDir, f'pred.model_idx_{i}.cif'), 80, seed=i)
+            if i < 2:  # the last model has no confidence sidecar
+                writeLddtCif(cifFile, cifFile, lddtSidecarPath(cifFile),
+                             rewrite=False)
+            self.fileNames.append(cifFile)
+
+    def _defattrFiles(self, first):
+        defattrFiles = []
+        for modelId, fileName in enumerate(self.fileNames, start=first):
+            sidecar = lddtSidecarPath(fileName)
+            if not os.path.exists(sidecar):
+                defattrFiles.append(None)
+                continue
+            defattrFile = lddtDefattrPath(fileName, modelId)
+            writeLddtDefattr(sidecar, defattrFile, modelId)
+            defattrFiles.append(defattrFile)
+        return defattrFiles
+
+    def test_commands(self):
+        defattrFiles = self._defattrFiles(first=2)
+        commands = chimeraModelCommands(self.fileNames, defattrFiles, 2,
+                                        shown=1)
+        self.assertTrue(all(command.endswith('\n') for command in commands))
+        self.assertEqual(commands, [
+            'open %s\n' % ' '.join(self.fileNames),
+            f'open {defattrFiles[0]}\n',
+            'color byattribute r:lddt #2 palette alphafold\n',
+            f'open {defattrFiles[1]}\n',
+            'color byattribute r:lddt #3 palette alphafold\n',
+            'color bfactor #4 palette alphafold\n',
+            'hide #3-4 models\n'])
+        for command in commands:
+            self.assertIn(command.split()[0], CHIMERAX_COMMANDS)
+
+    def test_defattrTargetsItsModel(self):
+        defattrFiles = self._defattrFiles(first=2)
+        for modelId, defattrFile in enumerate(defattrFiles[:2], start=2):
+            with open(defattrFile) as f:
+                specs = [line.split('\t')[1] for line in f
+                         if line.startswith('\t')]
+            self.assertTrue(specs)
+            self.assertTrue(all(spec.startswith(f'#{modelId}/')
+                                for spec in specs), specs[:3])
+
+    def test_showAll(self):
+        commands = chimeraModelCommands(self.fileNames, self._defattrFiles(2),
+                                        2, shown=0)
+        self.assertFalse([c for c in commands if c.startswith('hide')])
+        self.assertEqual(chimeraModelCommands([], [], 2), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Helpers to obtain and prepare the FASTA files folded by Chai-1.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from .constants import RCSB_FASTA_URL
+
+
+def reformatFastaLines(lines):
+    """ Yield the lines of an RCSB FASTA file with chai-lab headers. """
+    for line in lines:
+        if line.startswith('>'):
+            # Extract the protein name
+            parts = line.split('|')
+            if len(parts) > 2:
+                protein_name = parts[2].strip()
+            else:
+                protein_name = "Unknown protein"
+            yield f">protein|{protein_name}\n"
+        else:
+            yield line
+
+
+def reformatFastaFile(file_path):
+    """ Rewrite an RCSB FASTA file in place with chai-lab headers. """
+    with open(file_path, 'r') as f:
+        reformatted_lines = list(reformatFastaLines(f))
+
+    # Overwrite the file with reformatted content
+    with open(file_path, 'w') as f:
+        f.writelines(reformatted_lines)
+
+
+class FastaFetcher:
+    """ Download FASTA files of PDB entries from RCSB.
+
+    Requests go through a pooled HTTP session with timeouts and retries, the
+    reformatted responses are kept in an on-disk cache for ttl seconds and
+    several entries can be fetched concurrently with :meth:`fetchMany`.
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, url=RCSB_FASTA_URL, cacheDir=None, ttl=7 * 24 * 3600,
+                 timeout=30, retries=3, maxWorkers=8):
+        """
+        :param url: URL template, %s is replaced by the PDB ID.
+        :param cacheDir: folder of the response cache, None disables it.
+        :param ttl: seconds a cached response is considered valid.
+        :param timeout: seconds to wait for the server on every request.
+        :param retries: retries on connection errors and 429/5xx answers.
+        :param maxWorkers: concurrent downloads and pooled connections.
+        """
+        self.url = url
+        self.cacheDir = cacheDir
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retries = retries
+        self.maxWorkers = maxWorkers
+        self._session = None
+        if cacheDir:
+            os.makedirs(cacheDir, exist_ok=True)
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(total=self.retries, backoff_factor=0.5,
+                          status_forcelist=self.RETRY_STATUS)
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=self.maxWorkers,
+                                  max_retries=retry)
+            self._session = requests.Session()
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    def _cachePath(self, pdbId):
+        return os.path.join(self.cacheDir, pdbId.upper() + '.fasta')
+
+    def _isCached(self, pdbId):
+        if not self.cacheDir:
+            return False
+        fn = self._cachePath(pdbId)
+        return (os.path.exists(fn) and
+                time.time() - os.path.getmtime(fn) < self.ttl)
+
+    def _download(self, pdbId, outputPath):
+        """ Stream the response into outputPath, reformatting the headers. """
+        response = self.session.get(self.url % pdbId, timeout=self.timeout,
+                                    stream=True)
+        with response:
+            if response.status_code != 200:
+                raise Exception(f"No se pudo descargar el archivo FASTA para {pdbId}. "
+                                f"Código de estado: {response.status_code}")
+            response.encoding = response.encoding or 'utf-8'
+            lines = (line + '\n' for line in
+                     response.iter_lines(decode_unicode=True))
+            tmpPath = '%s.%d.tmp' % (outputPath, threading.get_ident())
+            with open(tmpPath, 'w') as f:
+                f.writelines(reformatFastaLines(lines))
+        os.replace(tmpPath, outputPath)
+
+    def fetch(self, pdbId, outputPath):
+        """ Write the chai-lab FASTA of pdbId to outputPath. """
+        if self.cacheDir:
+            cached = self._cachePath(pdbId)
+            if not self._isCached(pdbId):
+                self._download(pdbId, cached)
+            shutil.copyfile(cached, outputPath)
+        else:
+            self._download(pdbId, outputPath)
+        return outputPath
+
+    def fetchMany(self, jobs):
+        """ Fetch several entries concurrently.
+
+        :param jobs: list of (pdbId, outputPath) pairs.
+        :return: list of output paths in the same order as jobs.
+        """
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            return list(executor.map(lambda job: self.fetch(*job), jobs))
+
+
+def writeSequenceFasta(sequence, outputPath):
+    """ Write a pwem Sequence as a single-entry chai-lab FASTA file. """
+    entity = 'protein' if sequence.getIsAminoacids() else 'dna'
+    name = sequence.getSeqName() or sequence.getId() or 'sequence'
+    with open(outputPath, 'w') as f:
+        f.write(f">{entity}|{name}\n{sequence.getSequence()}\n")
+    return outputPath
+
+
+def targetName(name):
+    """ Name usable as file name and output attribute for a fold target. """
+    name = re.sub(r'\W', '_', os.path.splitext(os.path.basename(name))[0])
+    if not name or name[0].isdigit():
+        name = 'T_' + name
+    return name
+
+
+def fileChecksum(fileName, blockSize=1024 * 1024):
+    """ SHA-256 of a file, read in blocks. """
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def modelIndex(fileName):
+    """ Model index of a prediction file: the last number in its base name,
+    e.g. 0 for pred.model_idx_0.cif. Files without a number sort last. """
+    name = os.path.basename(fileName)
+    if name.endswith('.gz'):
+        name = name[:-len('.gz')]
+    numbers = re.findall(r'\d+', os.path.splitext(name)[0])
+    return int(numbers[-1]) if numbers else sys.maxsize
+
+
+def readServerArchive(serverfile):
+    """ Return the CIF members of a server ZIP, sorted by model index, and
+    the ranking score of each one (None when it is not available). """
+    try:
+        # ABRIR ARCHIVO .ZIP Y OBTENER LA INFORMACIÓN QUE NECESITAMOS.
+        with zipfile.ZipFile(serverfile, 'r') as zip_ref:
+            names = zip_ref.namelist()
+            cif_files = sorted((file for file in names if file.endswith('.cif')),
+                               key=modelIndex)
+            if not cif_files:
+                raise Exception(f"No se encontraron archivos .cif en el archivo ZIP: {serverfile}")
+
+            # OBTENER RANKING SCORES
+            json_files = [file for file in names if file.endswith('.json') and 'summary' in file]
+            if not json_files:
+                raise Exception(f"Not .json files found in the ZIP file: {serverfile}")
+            ranking_scores = {}
+            for json_file in json_files:
+                # Leer el contenido del archivo JSON
+                with zip_ref.open(json_file) as file:
+                    data = json.load(file)  # Cargar el JSON como diccionario
+                    if 'ranking_score' in data:
+                        ranking_scores[modelIndex(json_file)] = data['ranking_score']
+    except zipfile.BadZipFile:
+        raise Exception(f"El archivo proporcionado no es un ZIP válido: {serverfile}")
+    except FileNotFoundError:
+        raise Exception(f"No se encontró el archivo ZIP: {serverfile}")
+
+    return cif_files, [ranking_scores.get(modelIndex(file)) for file in cif_files]
+
+
+ENV_EXECUTABLES = ('python', 'chai-lab')
+
+
+def resolveEnvironment(activationCmd, name):
+    """ Activate a conda environment once and return its prefix and the
+    paths and modification times of its executables, see ENV_EXECUTABLES.
+
+    :param activationCmd: shell commands that activate the environment.
+    :param name: name of the environment, stored to validate the result.
+    :return: dict with the resolved environment, None if it fails.
+    """
+    import subprocess
+    cmd = '%s && python -c "import sys; print(sys.prefix)"' % activationCmd
+    result = subprocess.run(cmd, shell=True, executable='/bin/bash',
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    lines = result.stdout.strip().splitlines()
+    if result.returncode != 0 or not lines:
+        return None
+    prefix = lines[-1]
+    env = {'name': name, 'prefix': prefix, 'executables': {}}
+    for executable in ENV_EXECUTABLES:
+        path = os.path.join(prefix, 'bin', executable)
+        if not os.path.exists(path):
+            return None
+        env['executables'][executable] = [path, os.path.getmtime(path)]
+    return env
+
+
+def isEnvironmentValid(env, name):
+    """ True if env was resolved for name and its executables are still
+    the same files. """
+    if not env or env.get('name') != name:
+        return False
+    try:
+        return all(os.path.getmtime(path) == mtime
+                   for path, mtime in env['executables'].values())
+    except OSError:
+        return False
+
+
+def foldArgs(options):
+    """ chai-lab fold command line arguments of run_inference options,
+    e.g. {'num_trunk_recycles': 3} gives ['--num-trunk-recycles', '3'] and
+    {'use_msa_server': True} gives ['--use-msa-server']. """
+    args = []
+    for key, value in sorted(options.items()):
+        flag = key.replace('_', '-')
+        if isinstance(value, bool):
+            args.append(('--' if value else '--no-') + flag)
+        elif value is not None:
+            args += ['--' + flag, str(value)]
+    return args
@@ -3,4 +3,4 @@
 # Module to declare viewers
 # Find documentation here: https://scipion-em.github.io/docs/release-3.0.0/docs/developer/tutorials/course_day2.html#writing-a-viewer
 # **************************************************************************
-from .viewer import ChimeraChaiViewer
+from .viewers import ChimeraChaiViewer
@@ -1,22 +1,28 @@
 import os
+from functools import lru_cache
 
 import pyworkflow.viewer as pwviewer
 from pyworkflow.protocol import params
 from ..protocols.protocol_chai1 import Chai1Protocol
+from pwem.objects import AtomStruct, SetOfAtomStructs
 from pwem.viewers import ChimeraAttributeViewer
-import matplotlib.pyplot as plt
+import numpy as np
+from ..convert import (lddtSidecarPath, readLddtSidecar, LDDT_PREFIX,
+                       LDDT_SIDECAR_SUFFIX, errorMatrixPath, readErrorMatrix,
+                       downsampleMatrix, openText, lddtDefattrPath,
+                       writeLddtDefattr, LDDT_ATTRIBUTE)
 
 
-from pwem.viewers.viewer_chimera import (Chimera,
-                                         sessionFile)
-from chimera.objects import PAE
-
 class ChimeraChaiViewer(ChimeraAttributeViewer):
     _label = 'viewer chai1'
     _environments = [pwviewer.DESKTOP_TKINTER]
     _targets = [Chai1Protocol]
     _viewerOptions = ['ChimeraX']
-    _viewmodeloptions = ['MODEL 0', 'MODEL 1', 'MODEL 2', 'MODEL 3', 'MODEL 4']
+    # Above this number of residues the LDDT plots show per-window
+    # min/mean/max instead of one bar per residue
+    MAX_PLOT_POINTS = 2000
+    # Largest side of the PAE heatmaps, bigger matrices are averaged by blocks
+    MAX_PAE_PIXELS = 1000
 
     def _defineParams(self, form):
         form.addSection(label='Visualization of model in ChimeraX')
@@ -25,17 +31,36 @@ class ChimeraChaiViewer(ChimeraAttributeViewer):
                        choices=self._viewerOptions, default=0,
                        label='Display AtomStruct with: ',
                        help='Display the AtomStruct object with which software.\nAvailable: PyMol, ChimeraX')
+        group.addParam('shownModels', params.IntParam, default=1,
+                       label='Models shown: ',
+                       help='Number of models shown when ChimeraX opens, in '
+                            'output order (the best first for ranked '
+                            'predictions). The other models are loaded '
+                            'hidden and can be shown from the Models panel. '
+                            '0 shows all the models.')
         form.addSection(label='Visualization of LDDT information')
         group = form.addGroup('Display LDDT information')
         group.addParam('display', params.BooleanParam, default=False,
-                       labe='Do you want to display LDDT information?')
+                       label='Do you want to display LDDT information?')
         group.addParam('model', params.EnumParam,
                        label='Which model information do you want to diplay?',
-                       choices=self._viewmodeloptions, default=0, condition='display')
+                       choices=self._getModelOptions(), default=0, condition='display')
         form.addParam('viewConservation', params.LabelParam,
                       label='Display conservation over sequence: ',
                       help='Display a graph with the values of the selected attribute over the sequence.',
                       condition='display')
+        form.addParam('viewAllModels', params.LabelParam,
+                      label='Display LDDT of all models: ',
+                      help='Overlay the LDDT of every model in a single graph. '
+                           'Long sequences are summarized per window with '
+                           'the minimum, mean and maximum values.',
+                      condition='display')
+        form.addParam('viewPae', params.LabelParam,
+                      label='Display PAE of the model: ',
+                      help='Predicted aligned error of the selected model. '
+                           'Large matrices are averaged by blocks and read '
+                           'from disk as needed.',
+                      condition='display')
         form.addParam('information', params.IntParam, default=1,
                       label='Aminoacid Podition:',
                       help='Obtain information about the aminoacid that corresponds to each position',
@@ -43,153 +68,300 @@ class ChimeraChaiViewer(ChimeraAttributeViewer):
         form.addParam('name', params.LabelParam,
                       label='The name of the aminoacid located at the position specified is: ', condition='display')
 
-
-def _getVisualizeDict(self):
-    return {
-        'displaySoftware': self._viewAtomStruct,
-        'viewConservation': self._showlddt,
-        'name': self._showaminoacid,
-    }
-
-
-def _viewAtomStruct(self, e=None):
-    if self.displaySoftware.get() == 0:
-        return self._visualize(self.getAtomStruct())
-
-
-def getAtomStruct(self):
-    obj = self.protocol
-    return obj
-
-
-def _showlddt(self, paramName=None):
-    obj = self.protocol._outputs
-    fileNames = []
-
-    # Obtener las rutas absolutas de los archivos generados
-    for output in obj:
-        file_path = os.path.abspath(eval(f'self.protocol.{output}.getFileName()'))
-        fileNames.append(file_path)
-
+    def _getVisualizeDict(self):
+        return {
+            'displaySoftware': self._viewAtomStruct,
+            'viewConservation': self._showlddt,
+            'viewAllModels': self._showAllLddt,
+            'viewPae': self._showPae,
+            'name': self._showaminoacid,
+        }
+
+
+    def _viewAtomStruct(self, e=None):
+        if self.displaySoftware.get() == 0:
+            return self._visualize(self.getAtomStruct())
+
+
+    def getAtomStruct(self):
+        obj = self.protocol
+        return obj
+
+
+    def _showlddt(self, paramName=None):
+        import matplotlib.pyplot as plt
+        # Seleccionar el archivo del modelo especificado
+        model_index = self.model.get()
+        file_path = self._getModelFile(model_index)
+        if file_path is None:
+            return
+
+        confidence = getModelConfidence(file_path)
+        number, aa, values = confidence.numbers, confidence.names, confidence.values
+
+        if not len(aa) or not len(values):
+            print(f"No se encontraron datos LDDT en {file_path}")
+            return
+
+        fig, ax = plt.subplots(figsize=(12, 5))
+
+        if len(values) > self.MAX_PLOT_POINTS:
+            self._plotWindows(ax, values, color='r', label=f'MODEL {model_index}')
+        else:
+            # Crear el gráfico de barras
+            ax.bar(number, values, color='r', alpha=0.7)
+        self._showLddtPlot(ax, f'LDDT per aminoacid - MODEL: {model_index}',
+                           max(number))
+
+    def _showAllLddt(self, paramName=None):
+        import matplotlib.pyplot as plt
+        fileNames = self._getModelFiles()
+        if not fileNames:
+            print("No se encontraron archivos de salida.")
+            return
+
+        fig, ax = plt.subplots(figsize=(12, 5))
+        colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+        length = 0
+        for i, file_path in enumerate(fileNames):
+            values = getModelConfidence(file_path).values
+            if not len(values):
+                continue
+            color = colors[i % len(colors)]
+            if len(values) > self.MAX_PLOT_POINTS:
+                self._plotWindows(ax, values, color=color, label=f'MODEL {i}')
+            else:
+                ax.plot(np.arange(1, len(values) + 1), values, color=color,
+                        linewidth=1, label=f'MODEL {i}')
+            length = max(length, len(values))
+        ax.legend(loc='lower right')
+        self._showLddtPlot(ax, 'LDDT per aminoacid - ALL MODELS', length)
+
+    def _showPae(self, paramName=None):
+        import matplotlib.pyplot as plt
+        model_index = self.model.get()
+        file_path = self._getModelFile(model_index)
+        if file_path is None:
+            return
+        paeFile = errorMatrixPath(file_path)
+        if not os.path.exists(paeFile):
+            print(f"No se encontró la matriz PAE del modelo en {paeFile}")
+            return
+
+        matrix = readErrorMatrix(paeFile)
+        values, window = downsampleMatrix(matrix, self.MAX_PAE_PIXELS)
+        n = matrix.shape[0]
+        fig, ax = plt.subplots(figsize=(7, 6))
+        image = ax.imshow(values, cmap='Greens_r', vmin=0,
+                          extent=(0.5, n + 0.5, n + 0.5, 0.5))
+        fig.colorbar(image, ax=ax, label='Expected position error (Å)')
+        ax.set_xlabel('Scored token', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Aligned token', fontsize=12, fontweight='bold')
+        title = f'PAE - MODEL: {model_index}'
+        if window > 1:
+            title += f' (mean of {window}x{window} blocks)'
+        ax.set_title(title, fontsize=14, fontweight='bold')
+        plt.tight_layout()
+        plt.show()
+
+    def _plotWindows(self, ax, values, color, label):
+        """ Plot the mean LDDT per window as a line and the min-max range of
+        every window as a band, with at most MAX_PLOT_POINTS windows. """
+        centers, mins, means, maxs = downsample(values, self.MAX_PLOT_POINTS)
+        ax.fill_between(centers, mins, maxs, color=color, alpha=0.2,
+                        linewidth=0)
+        ax.plot(centers, means, color=color, linewidth=1, label=label)
+
+    def _showLddtPlot(self, ax, title, length):
+        import matplotlib.pyplot as plt
+        # Configuración del diseño
+        ax.set_xlabel('Aminoacid number', fontsize=12, fontweight='bold')
+        ax.set_ylabel('LDDT value', fontsize=12, fontweight='bold')
+        ax.set_title(title, fontsize=14, fontweight='bold')
+
+        # Marcas en el eje X cada 100 residuos, o menos marcas si la secuencia es larga
+        step = 100 * max(1, int(np.ceil(length / 2000)))
+        ax.set_xticks(range(0, length + 1, step))
+
+        # Activar la cuadrícula
+        ax.grid(axis='y', linestyle='--', alpha=0.7)
+
+        # Ajustar el diseño para evitar solapamiento
+        plt.tight_layout()
+
+        # Mostrar la gráfica
+        plt.show()
+
+    def _getModelOptions(self):
+        """ One entry per predicted model of the protocol. """
+        nModels = len(self._getModelFiles())
+        return ['MODEL %d' % i for i in range(max(nModels, 1))]
+
+    def _showaminoacid(self, event=None):
+        file_path = self._getModelFile(self.model.get())
+        if file_path is None:
+            return
+        confidence = getModelConfidence(file_path)
+        position = int(self.information.get())
+        if not 1 <= position <= len(confidence):
+            print(f"La posición {position} no existe, el modelo tiene "
+                  f"{len(confidence)} residuos.")
+            return
+        print(confidence.names[position - 1])
+
+    def _getModelFiles(self):
+        """ Absolute paths of the predicted models, in output order. Both
+        single AtomStruct outputs and sets of them are supported. The list
+        is built once per viewer. """
+        if getattr(self, '_modelFiles', None) is not None:
+            return self._modelFiles
+        fileNames = []
+        for _, output in self.protocol.iterOutputAttributes():
+            if isinstance(output, SetOfAtomStructs):
+                fileNames.extend(os.path.abspath(item.getFileName())
+                                 for item in output.iterItems())
+            elif isinstance(output, AtomStruct):
+                fileNames.append(os.path.abspath(output.getFileName()))
+        self._modelFiles = fileNames
+        return fileNames
+
+    def _getModelFile(self, model_index):
+        fileNames = self._getModelFiles()
+        if not fileNames:
+            print("No se encontraron archivos de salida.")
+            return None
+        if model_index >= len(fileNames):
+            print(f"El modelo seleccionado ({model_index}) no existe.")
+            return None
+        return fileNames[model_index]
+
+    def _getDefattrFile(self, fileName, modelId):
+        """ ChimeraX attribute file with the LDDT of a model opened as
+        #modelId, written from its confidence sidecar when missing or
+        outdated. None for models without sidecar. """
+        sidecar = lddtSidecarPath(fileName)
+        if not os.path.exists(sidecar):
+            return None
+        defattrFile = lddtDefattrPath(fileName, modelId)
+        if (not os.path.exists(defattrFile) or
+                os.path.getmtime(defattrFile) < os.path.getmtime(sidecar)):
+            writeLddtDefattr(sidecar, defattrFile, modelId)
+        return defattrFile
+
+    def _visualize(self, obj, **args):
+        """ Open all the models in ChimeraX with a single script, see
+        chimeraModelCommands. Only the first shownModels models are
+        displayed. """
+        from pwem.viewers.viewer_chimera import Chimera
+        # create axis file
+        models = 1
+        dim = 150
+        sampling = 1.
+        extraFileName = os.path.abspath(self.protocol._getExtraPath("axis_input.bild"))
+        Chimera.createCoordinateAxisFile(dim,
+                                         bildFileName=extraFileName,
+                                         sampling=sampling)
+
+        fnCmd = self.protocol._getExtraPath("chimera_alphafold.cxc")
+        f = open(fnCmd, 'w')
+        f.write("open %s\n" % extraFileName)
+        models += 1
+        f.write("cofr 0,0,0\n")  # set center of coordinates
+        # change to workingDir
+        # If we do not use cd and the project name has an space
+        # the protocol fails even if we pass absolute paths
+        f.write('cd %s\n' % os.getcwd())
+
+        # get path to atomstructs, only atomic structs are shown in chimera
+        fileNames = [fileName for fileName in self._getModelFiles()
+                     if fileName.endswith((".cif", ".cif.gz", ".pdb"))]
+        defattrFiles = [self._getDefattrFile(fileName, modelId)
+                        for modelId, fileName in enumerate(fileNames,
+                                                           start=models)]
+        f.writelines(chimeraModelCommands(fileNames, defattrFiles, models,
+                                          self.shownModels.get()))
+        f.write("key red:low orange: yellow: cornflowerblue: blue:high\n")
+        f.close()
+        Chimera.runProgram(Chimera.getProgram(), fnCmd + "&")
+
+
+def chimeraModelCommands(fileNames, defattrFiles, first, shown=0):
+    """ ChimeraX commands that open fileNames as the models first, first + 1...
+
+    Each model is colored by the LDDT residue attribute of its defattr file,
+    written by writeLddtDefattr for that model id, so the CIF files are read
+    as chai-lab wrote them. Models without defattr file (None) are colored
+    by B-factor. Only the first shown models are displayed, 0 shows all.
+
+    :return: list of command lines.
+    """
     if not fileNames:
-        print("No se encontraron archivos de salida.")
-        return
-
-    # Seleccionar el archivo del modelo especificado
-    model_index = self.model.get()
-    if model_index >= len(fileNames):
-        print(f"El modelo seleccionado ({model_index}) no existe.")
-        return
-
-    file_path = fileNames[model_index]
+        return []
+    # A single open command, every file is a new model
+    commands = ["open %s\n" % " ".join(fileNames)]
+    for modelId, defattrFile in enumerate(defattrFiles, start=first):
+        # set alphafold colormap
+        if defattrFile:
+            commands.append(f"open {defattrFile}\n")
+            commands.append(f"color byattribute r:{LDDT_ATTRIBUTE} "
+                            f"#{modelId} palette alphafold\n")
+        else:
+            commands.append(f"color bfactor #{modelId} palette alphafold\n")
+    last = first + len(fileNames) - 1
+    if 0 < shown < len(fileNames):
+        commands.append(f"hide #{first + shown}-{last} models\n")
+    return commands
+
+def downsample(values, maxPoints):
+    """ Summarize values in at most maxPoints consecutive windows.
+
+    :return: (centers, mins, means, maxs) arrays with one entry per window,
+             centers are 1-based residue positions.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    window = max(1, int(np.ceil(len(values) / maxPoints)))
+    starts = np.arange(0, len(values), window)
+    counts = np.diff(np.append(starts, len(values)))
+    mins = np.minimum.reduceat(values, starts)
+    maxs = np.maximum.reduceat(values, starts)
+    means = np.add.reduceat(values, starts) / counts
+    centers = starts + (counts + 1) / 2.
+    return centers, mins, means, maxs
+
+
+class ModelConfidence:
+    """ Per-residue confidence of a model, indexed by residue position. """
+
+    def __init__(self, names, values):
+        self.names = np.asarray(names)
+        self.values = np.asarray(values)
+        self.numbers = np.arange(1, len(self.values) + 1)
+
+    def __len__(self):
+        return len(self.values)
+
+
+def getModelConfidence(file_path):
+    """ Confidence of the model in file_path. Results are cached by file and
+    modification time, so browsing models does not read them again. """
+    sidecar = lddtSidecarPath(file_path)
+    source = sidecar if os.path.exists(sidecar) else file_path
+    return _loadModelConfidence(source, os.path.getmtime(source))
+
+
+@lru_cache(maxsize=32)
+def _loadModelConfidence(source, mtime):
+    if source.endswith(LDDT_SIDECAR_SUFFIX):
+        residues = readLddtSidecar(source)
+        return ModelConfidence(residues['name'].astype(str), residues['lddt'])
+
+    # Modelos antiguos: leer el bucle LDDT añadido al archivo CIF
     aa = []
     values = []
-    number = []
-    # Leer el archivo y extraer los datos de LDDT
-    with open(file_path, 'r') as f:
+    with openText(source) as f:
         for line in f:
-            if line.startswith('LDDT residues:'):
+            if line.startswith(LDDT_PREFIX):
                 parts = line.split()
-                number.append(int(parts[2]))
                 aa.append(parts[3])  # Aminoácido
                 values.append(float(parts[4]))  # Valor LDDT
-
-    if not aa or not values:
-        print(f"No se encontraron datos LDDT en {file_path}")
-        return
-
-    fig, ax = plt.subplots(figsize=(12, 5))
-
-    # Crear el gráfico de barras
-    ax.bar(number, values, color='r', alpha=0.7)
-
-    # Configuración del diseño
-    ax.set_xlabel('Aminoacid number', fontsize=12, fontweight='bold')
-    ax.set_ylabel('LDDT value', fontsize=12, fontweight='bold')
-    ax.set_title(f'LDDT per aminoacid - MODEL: {model_index}', fontsize=14, fontweight='bold')
-
-    # Establecer marcas en el eje X cada 100
-    ax.set_xticks(range(0, max(number) + 1, 100))
-
-    # Activar la cuadrícula
-    ax.grid(axis='y', linestyle='--', alpha=0.7)
-
-    # Ajustar el diseño para evitar solapamiento
-    plt.tight_layout()
-
-    # Mostrar la gráfica
-    plt.show()
-
-
-def _showaminoacid(self, event=None):
-    obj = self.protocol._outputs
-    fileNames = []
-
-    # Obtener las rutas absolutas de los archivos generados
-    for output in obj:
-        file_path = os.path.abspath(eval(f'self.protocol.{output}.getFileName()'))
-        fileNames.append(file_path)
-
-    if not fileNames:
-        print("No se encontraron archivos de salida.")
-        return
-
-    # Seleccionar el archivo del modelo especificado
-    model_index = self.model.get()
-    if model_index >= len(fileNames):
-        print(f"El modelo seleccionado ({model_index}) no existe.")
-        return
-
-    file_path = fileNames[model_index]
-    aa = []
-    with open(file_path, 'r') as f:
-        for line in f:
-            if line.startswith('LDDT residues:'):
-                parts = line.split()
-                aa.append(parts[3])  # Aminoácido
-    information = self.information.get()
-    position = int(information)
-    aminoacid = aa[position]
-    print(aminoacid)
-
-
-def _visualize(self, obj, **args):
-    # create axis file
-    models = 1
-    dim = 150
-    sampling = 1.
-    extraFileName = os.path.abspath(self.protocol._getExtraPath("axis_input.bild"))
-    Chimera.createCoordinateAxisFile(dim,
-                                     bildFileName=extraFileName,
-                                     sampling=sampling)
-
-    fnCmd = self.protocol._getExtraPath("chimera_alphafold.cxc")
-    f = open(fnCmd, 'w')
-    f.write("open %s\n" % extraFileName)
-    models += 1
-    f.write("cofr 0,0,0\n")  # set center of coordinates
-    # change to workingDir
-    # If we do not use cd and the project name has an space
-    # the protocol fails even if we pass absolute paths
-    f.write('cd %s\n' % os.getcwd())
-
-    # get path to atomstructs
-    for output in self.protocol._outputs:
-        # if the file is an atomic struct show it in chimera
-        fileName = os.path.abspath(eval(f'self.protocol.{output}.getFileName()'))
-        if fileName.endswith(".cif") or fileName.endswith(".pdb"):
-            f.write("open %s\n" % fileName)
-            models += 1
-    # if exists upload other results files
-    # model_?_unrelaxed.pdb
-    # pattern = self.protocol._getExtraPath("results/model_?_unrelaxed.pdb")
-    # from glob import glob
-    # for model in glob(pattern):
-    #    f.write("open %s\n" % model)
-    #    f.write(f"hide #{models} models\n")
-    #    models +=1
-    # set alphafold colormap
-    f.write("color bfactor palette alphafold\n")
-    f.write("key red:low orange: yellow: cornflowerblue: blue:high\n")
-    f.close()
-    Chimera.runProgram(Chimera.getProgram(), fnCmd + "&")
+    return ModelConfidence(aa, values)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     you (you@yourinstitution.email)
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+"""
+Client side of the persistent chai-lab worker.
+
+The worker (chai1/scripts/chai1_worker.py) runs in the Chai-1 environment,
+keeps torch and chai-lab imported between predictions and serves fold
+requests over a local socket. Each request is a dict with the FASTA file,
+the output directory and the keyword options of chai-lab run_inference;
+the reply is a dict with a status and, on failure, a message.
+"""
+from multiprocessing.connection import Client
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+
+
+def connect(address):
+    """ Connect to the worker listening at address.
+
+    :return: the connection, or None when no worker is running there.
+    """
+    if not address:
+        return None
+    try:
+        return Client(address)
+    except (OSError, EOFError):
+        return None
+
+
+def submitFold(conn, fastaFile, outputDir, **options):
+    """ Send a fold request through conn and wait for its completion. """
+    conn.send({'fasta': fastaFile, 'output_dir': outputDir,
+               'options': options})
+    reply = conn.recv()
+    if reply.get('status') != STATUS_OK:
+        raise Exception(f"chai-lab worker failed to fold {fastaFile}: "
+                        f"{reply.get('message')}")
+    return reply